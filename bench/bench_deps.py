@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Compares the time needed to load a large DEPS file with plain CSON
+parsing and through crater's compiled DEPS cache.
+
+    $ python bench/bench_deps.py [--deps N] [--gen N] [--repeat N]
+"""
+
+from __future__ import print_function
+import argparse, os, shutil, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def _make_deps(deps, gen):
+    lines = ['dependencies:']
+    for i in range(deps):
+        lines.append("  dep{}:".format(i))
+        lines.append("    type: 'git'")
+        lines.append("    url: 'https://example.com/vendor/dep{}.git'".format(i))
+        lines.append("    branch: ['master', 'release-{}']".format(i))
+    lines.append('gen:')
+    lines.append('  cmake:')
+    lines.append("    prop_prefix: 'dep_'")
+    lines.append('  msbuild:')
+    lines.append('    props: [')
+    for i in range(gen):
+        lines.append("      {{ name: 'prop{}', value: 'value {}' }}".format(i, i))
+    lines.append('    ]')
+    return '\n'.join(lines) + '\n'
+
+def _best(fn, repeat):
+    r = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        t = time.time() - start
+        r = t if r is None else min(r, t)
+    return r
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--deps', type=int, default=50)
+    ap.add_argument('--gen', type=int, default=2000)
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    cache_dir = tempfile.mkdtemp()
+    os.environ['CRATER_CACHE_DIR'] = cache_dir
+    try:
+        import cson
+        from crater.depsfile import load_deps, parse_deps
+
+        path = os.path.join(cache_dir, 'DEPS')
+        text = _make_deps(args.deps, args.gen)
+        with open(path, 'w') as fout:
+            fout.write(text)
+
+        # Make the file old enough for its stat data to be trusted.
+        past = time.time() - 60
+        os.utime(path, (past, past))
+
+        data = text.encode('utf-8')
+        assert parse_deps(data) == cson.loads(text)
+        load_deps(path)
+
+        results = [
+            ('cson.loads', _best(lambda: cson.loads(text), args.repeat)),
+            ('parse_deps (cached)', _best(lambda: parse_deps(data), args.repeat)),
+            ('load_deps (unchanged file)', _best(lambda: load_deps(path), args.repeat)),
+            ]
+
+        print('DEPS size: {} bytes'.format(len(data)))
+        for name, t in results:
+            print('{:<28} {:>10.2f} ms'.format(name, t * 1000))
+    finally:
+        from crater.cache import compiled_deps_cache, deps_files_cache
+        compiled_deps_cache().close()
+        deps_files_cache().close()
+        shutil.rmtree(cache_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Times crater commands on a synthetic dependency graph of local git remotes.
+
+    $ python bench/bench_graph.py [--crates N] [--depth N] [--fanin N]
+          [--history N] [--repeat N] [--jobs N] [--git-backend NAME]
+          [--output FILE]
+
+The crates are split into `depth` levels. The project depends on every
+crate of the first level and each crate depends on `fanin` crates of
+the next one, so crates deeper down are shared by several dependents.
+Every remote has `history` commits on master.
+
+The results are written as JSON to `--output`, so that runs of different
+crater versions can be compared.
+"""
+
+from __future__ import print_function
+import argparse, io, json, os, platform, random, shutil, subprocess, sys, tempfile, time
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, _root)
+
+from crater import crater
+from crater.log import Log
+
+def _make_graph(crates, depth, fanin, rng):
+    """
+    Returns a list of the crates' dependencies, the first `depth` crates
+    being at the top level.
+    """
+
+    levels = [list(range(l, crates, depth)) for l in range(depth)]
+    deps = [set() for _ in range(crates)]
+    for upper, lower in zip(levels, levels[1:]):
+        if not upper:
+            break
+
+        # Every crate must be reachable from the level above.
+        for i, c in enumerate(lower):
+            deps[upper[i % len(upper)]].add(c)
+
+        for c in upper:
+            want = min(fanin, len(lower))
+            while len(deps[c]) < want:
+                deps[c].add(rng.choice(lower))
+
+    return levels[0], [sorted(d) for d in deps]
+
+def _deps_file(deps, remotes):
+    return json.dumps({
+        'dependencies': dict(('crate{}'.format(d), { 'type': 'git', 'url': remotes[d] }) for d in deps),
+        }, indent=4, sort_keys=True).encode('utf-8')
+
+def _make_remote(path, deps_file, history):
+    subprocess.check_call(['git', 'init', '-q', '--bare', path])
+    subprocess.check_call(['git', 'symbolic-ref', 'HEAD', 'refs/heads/master'], cwd=path)
+
+    # fast-import builds the whole history in a single process.
+    stream = []
+    def data(s):
+        stream.append('data {}\n'.format(len(s)).encode())
+        stream.append(s)
+        stream.append(b'\n')
+
+    for i in range(history):
+        stream.append(b'commit refs/heads/master\n')
+        stream.append('mark :{}\n'.format(i + 1).encode())
+        stream.append('committer Bench <bench@example.com> {} +0000\n'.format(1500000000 + i * 60).encode())
+        data('commit {}'.format(i + 1).encode())
+        if i:
+            stream.append('from :{}\n'.format(i).encode())
+        stream.append(b'M 644 inline DEPS\n')
+        data(deps_file)
+        stream.append(b'M 644 inline history.txt\n')
+        data('{}\n'.format(i).encode())
+        stream.append(b'\n')
+
+    p = subprocess.Popen(['git', 'fast-import', '--quiet'], stdin=subprocess.PIPE, cwd=path)
+    p.communicate(b''.join(stream))
+    if p.returncode != 0:
+        raise RuntimeError('git fast-import failed in {}'.format(path))
+
+def _rmtree(path):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+
+class _Bench:
+    def __init__(self, dir, args):
+        self.dir = dir
+        self.args = args
+        self.project = os.path.join(dir, 'project')
+        self.cache = os.path.join(dir, 'cache')
+
+    def build(self):
+        args = self.args
+        rng = random.Random(args.seed)
+        top, deps = _make_graph(args.crates, args.depth, args.fanin, rng)
+
+        remotes = [os.path.join(self.dir, 'remotes', 'crate{}.git'.format(i)) for i in range(args.crates)]
+        for i, remote in enumerate(remotes):
+            _make_remote(remote, _deps_file(deps[i], remotes), args.history)
+
+        self._deps_file = _deps_file(top, remotes)
+        self.edges = sum(len(d) for d in deps) + len(top)
+
+    def reset(self):
+        # A fresh project and empty caches, as if crater never ran here.
+        _rmtree(self.project)
+        _rmtree(self.cache)
+        os.makedirs(self.project)
+        os.makedirs(self.cache)
+        subprocess.check_call(['git', 'init', '-q'], cwd=self.project)
+        with open(os.path.join(self.project, 'DEPS'), 'wb') as fout:
+            fout.write(self._deps_file)
+
+    def drop_checkout_state(self):
+        _rmtree(os.path.join(self.project, '.git', 'crater'))
+
+    def drop_working_trees(self):
+        self.drop_checkout_state()
+        _rmtree(os.path.join(self.project, '_deps'))
+
+    def run(self, argv):
+        out = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        log = Log(sys.stderr if self.args.verbose else out)
+
+        prev_dir = os.getcwd()
+        prev_stdout = sys.stdout
+        os.chdir(self.project)
+        if not self.args.verbose:
+            sys.stdout = out
+        try:
+            start = time.time()
+            r = crater._main(['--root', self.project, '--git-backend', self.args.git_backend] + argv, log)
+            t = time.time() - start
+        finally:
+            sys.stdout = prev_stdout
+            os.chdir(prev_dir)
+
+        if r:
+            sys.stderr.write(out.getvalue())
+            raise RuntimeError('crater {} failed'.format(' '.join(argv)))
+        return t
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--crates', type=int, default=30)
+    ap.add_argument('--depth', type=int, default=4)
+    ap.add_argument('--fanin', type=int, default=3)
+    ap.add_argument('--history', type=int, default=200)
+    ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--repeat', type=int, default=3)
+    ap.add_argument('--jobs', '-j', type=int, default=8)
+    ap.add_argument('--git-backend', choices=crater.git_backends, default='git')
+    ap.add_argument('--output', '-o', default='bench_graph.json')
+    ap.add_argument('--verbose', '-v', action='store_true')
+    args = ap.parse_args()
+
+    jobs = ['-j', str(args.jobs)]
+
+    # Each scenario is a name, the preparation that isn't timed
+    # and the command line. They run in this order.
+    scenarios = [
+        ('upgrade (cold)', 'reset', ['upgrade']),
+        ('upgrade (warm)', None, ['upgrade']),
+        ('gen', None, ['gen']),
+        ('status', None, ['status'] + jobs),
+        ('commit', None, ['commit'] + jobs),
+        ('checkout (unchanged)', None, ['checkout'] + jobs),
+        ('checkout (no state)', 'drop_checkout_state', ['checkout'] + jobs),
+        ('checkout (clone)', 'drop_working_trees', ['checkout'] + jobs),
+        ]
+
+    dir = tempfile.mkdtemp()
+    prev_cache_dir = os.environ.get('CRATER_CACHE_DIR')
+    try:
+        bench = _Bench(dir, args)
+
+        start = time.time()
+        bench.build()
+        print('built {} remotes with {} edges in {:.2f} s'.format(args.crates, bench.edges, time.time() - start))
+
+        os.environ['CRATER_CACHE_DIR'] = bench.cache
+
+        times = dict((name, []) for name, _, _ in scenarios)
+        for _ in range(args.repeat):
+            for name, prepare, argv in scenarios:
+                if prepare is not None:
+                    getattr(bench, prepare)()
+                times[name].append(bench.run(argv))
+    finally:
+        if prev_cache_dir is None:
+            os.environ.pop('CRATER_CACHE_DIR', None)
+        else:
+            os.environ['CRATER_CACHE_DIR'] = prev_cache_dir
+        shutil.rmtree(dir)
+
+    try:
+        revision = subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=_root, stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    results = {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'git': subprocess.check_output(['git', '--version']).decode().strip(),
+        'params': {
+            'crates': args.crates,
+            'depth': args.depth,
+            'fanin': args.fanin,
+            'history': args.history,
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'jobs': args.jobs,
+            'git_backend': args.git_backend,
+            },
+        'commands': [],
+        }
+
+    print('{:<24} {:>10} {:>10} {:>10}'.format('command', 'min [s]', 'median [s]', 'max [s]'))
+    for name, _, argv in scenarios:
+        t = sorted(times[name])
+        median = t[len(t) // 2]
+        print('{:<24} {:>10.3f} {:>10.3f} {:>10.3f}'.format(name, t[0], median, t[-1]))
+        results['commands'].append({
+            'name': name,
+            'argv': argv,
+            'times': times[name],
+            'min': t[0],
+            'median': median,
+            'max': t[-1],
+            })
+
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=4, sort_keys=True)
+        fout.write('\n')
+
+if __name__ == '__main__':
+    main()
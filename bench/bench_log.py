@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Measures the CPU time crater spends relaying the output of chatty
+child processes through `Log`, compared to the original line-by-line
+implementation.
+
+    $ python bench/bench_log.py [--lines N] [--repeat N]
+"""
+
+from __future__ import print_function
+import argparse, io, os, subprocess, sys, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from crater.log import Log
+
+import colorama
+
+class _LegacyDimmer:
+    def __init__(self, stream):
+        self._stream = colorama.AnsiToWin32(stream, convert=True, strip=True, autoreset=True)
+
+    def write(self, s):
+        self._stream.write(colorama.Style.BRIGHT + colorama.Fore.BLACK + s)
+
+    def flush(self):
+        pass
+
+class LegacyLog:
+    # The subprocess handling of crater 0.6, kept here for comparison.
+
+    def __init__(self, stderr):
+        self._stderr = stderr
+        self._dimmed = colorama.AnsiToWin32(_LegacyDimmer(stderr), convert=False, strip=True, autoreset=False)
+        self._devnull = open(os.devnull, 'r+b')
+
+    def call(self, *args, **kw):
+        kw['stdout'] = subprocess.PIPE
+        kw['stderr'] = subprocess.STDOUT
+        p = subprocess.Popen(*args, **kw)
+        while True:
+            line = p.stdout.readline()
+            if not line:
+                break
+            self._dimmed.write(line.decode())
+        p.wait()
+        return p.returncode
+
+    def check_output(self, *args, **kw):
+        p = subprocess.Popen(*args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kw)
+
+        stdout = []
+        def reader():
+            stdout.append(p.stdout.read())
+
+        thr = threading.Thread(target=reader)
+        thr.start()
+
+        line = []
+        while True:
+            line.append(p.stderr.read(1))
+            if not line[-1]:
+                self._dimmed.write(b''.join(line[:-1]).decode())
+                break
+
+            if line[-1] in b'\r\n':
+                self._dimmed.write(b''.join(line).decode())
+                line = []
+
+        thr.join()
+        p.wait()
+        return stdout[0]
+
+def _child(lines):
+    # Mimics `git clone` progress on stderr and `git log` on stdout.
+    return [sys.executable, '-c', '''
+import sys
+for i in range({lines}):
+    sys.stderr.write('Receiving objects: {{}}% ({{}}/{lines})\\r'.format(i * 100 // {lines}, i))
+    sys.stdout.write('{{:040x}}\\n'.format(i))
+'''.format(lines=lines)]
+
+def _measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start_cpu = time.process_time() if hasattr(time, 'process_time') else time.clock()
+        start = time.time()
+        fn()
+        wall = time.time() - start
+        cpu = (time.process_time() if hasattr(time, 'process_time') else time.clock()) - start_cpu
+        if best is None or cpu < best[1]:
+            best = wall, cpu
+    return best
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--lines', type=int, default=100000)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    cmd = _child(args.lines)
+
+    print('{:<14} {:<12} {:>10} {:>10}'.format('impl', 'method', 'wall [s]', 'cpu [s]'))
+    for name, cls in (('legacy', LegacyLog), ('crater', Log)):
+        for method in ('call', 'check_output'):
+            log = cls(io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO())
+            wall, cpu = _measure(lambda: getattr(log, method)(cmd), args.repeat)
+            print('{:<14} {:<12} {:>10.3f} {:>10.3f}'.format(name, method, wall, cpu))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Measures how long it takes to import crater's command line interface,
+using `python -X importtime` (Python 3.7+), and fails if it exceeds
+the budget.
+
+    $ python bench/bench_startup.py [--repeat N] [--budget MS] [--top N]
+
+Bytecode is compiled into a temporary cache first, so that the numbers
+reflect an installed crater rather than the compiler.
+"""
+
+from __future__ import print_function
+import argparse, os, re, shutil, subprocess, sys, tempfile
+
+_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Modules only some subcommands need; importing crater must not load them.
+_deferred = ('cson', 'toposort', 'colorama', 'sqlite3', 'multiprocessing', 'hashlib', 'requests', 'crater.archivecrate', 'crater.solver', 'crater.gitgraph', 'crater.depsfile', 'crater.gitobjects')
+
+_line_re = re.compile(r'^import time:\s*(\d+)\s*\|\s*(\d+)\s*\|( *)(\S+)\s*$')
+
+def _run(env):
+    p = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', 'import crater.crater'],
+        stderr=subprocess.PIPE, env=env, cwd=_root)
+    _, err = p.communicate()
+    if p.returncode != 0:
+        sys.stderr.write(err.decode('utf-8', 'replace'))
+        raise RuntimeError('failed to import crater')
+
+    # Modules are listed as they finish importing; everything after `site`
+    # was imported by crater.
+    r = []
+    for line in err.decode('utf-8', 'replace').splitlines():
+        m = _line_re.match(line)
+        if not m:
+            continue
+        if m.group(4) == 'site' and len(m.group(3)) == 1:
+            r = []
+        else:
+            r.append((m.group(4), int(m.group(1)), int(m.group(2))))
+
+    total = next(cum for name, _, cum in r if name == 'crater.crater')
+    return total, r
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--repeat', type=int, default=10)
+    ap.add_argument('--budget', type=float, default=30.0, help='maximum median import time in milliseconds')
+    ap.add_argument('--top', type=int, default=10)
+    args = ap.parse_args()
+
+    if sys.version_info < (3, 7):
+        print('-X importtime requires Python 3.7 or newer', file=sys.stderr)
+        return 2
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        env = dict(os.environ)
+        env.pop('PYTHONDONTWRITEBYTECODE', None)
+        env['PYTHONPYCACHEPREFIX'] = cache_dir
+        env['PYTHONPATH'] = os.pathsep.join([_root] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        _run(env)
+        runs = [_run(env) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(cache_dir)
+
+    runs.sort(key=lambda run: run[0])
+    total, modules = runs[len(runs) // 2]
+
+    print('{:<40} {:>10}'.format('module', 'self [ms]'))
+    for name, self_us, _ in sorted(modules, key=lambda e: -e[1])[:args.top]:
+        print('{:<40} {:>10.2f}'.format(name, self_us / 1000.0))
+    print()
+
+    median = total / 1000.0
+    print('import crater.crater: median {:.2f} ms, min {:.2f} ms, max {:.2f} ms (budget {:.2f} ms)'.format(
+        median, runs[0][0] / 1000.0, runs[-1][0] / 1000.0, args.budget))
+
+    r = 0
+    loaded = set(name for name, _, _ in modules)
+    for name in _deferred:
+        if name in loaded:
+            print('error: {} is imported at startup'.format(name), file=sys.stderr)
+            r = 1
+
+    if median > args.budget:
+        print('error: startup is over budget', file=sys.stderr)
+        r = 1
+
+    return r
+
+if __name__ == '__main__':
+    sys.exit(main())
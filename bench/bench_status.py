@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Measures how long `crater status` takes to tell that a clean crate is
+still clean when git needn't run, compared to walking the whole working
+tree as crater 0.6 did. The crate has tracked sources and a larger
+untracked build directory.
+
+    $ python bench/bench_status.py [--tracked N] [--untracked N] [--repeat N]
+"""
+
+from __future__ import print_function
+import argparse, json, os, shutil, stat, subprocess, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from crater.gitcrate import git_handler
+from crater.log import Log
+
+def _legacy_tree_changed_since(path, t):
+    # The check of crater 0.6, kept here for comparison.
+    stack = [path]
+    while stack:
+        dir = stack.pop()
+        try:
+            names = os.listdir(dir)
+        except OSError:
+            return True
+
+        for name in names:
+            if dir == path and name == '.git':
+                continue
+
+            child = os.path.join(dir, name)
+            try:
+                st = os.lstat(child)
+            except OSError:
+                return True
+
+            if st.st_mtime >= t or st.st_ctime >= t:
+                return True
+            if stat.S_ISDIR(st.st_mode):
+                stack.append(child)
+    return False
+
+def _write_files(root, prefix, n):
+    for i in range(n):
+        dir = os.path.join(root, prefix, 'd{}'.format(i // 100))
+        if i % 100 == 0:
+            os.makedirs(dir)
+        with open(os.path.join(dir, 'f{}'.format(i)), 'w') as fout:
+            fout.write(str(i))
+
+def _measure(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--tracked', type=int, default=2000)
+    ap.add_argument('--untracked', type=int, default=50000)
+    ap.add_argument('--repeat', type=int, default=5)
+    args = ap.parse_args()
+
+    root = tempfile.mkdtemp()
+    try:
+        subprocess.check_call(['git', 'init', '-q', root])
+        _write_files(root, 'src', args.tracked)
+        subprocess.check_call(['git', 'add', '.'], cwd=root)
+        subprocess.check_call(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com', 'commit', '-q', '-m', 'bench'], cwd=root)
+        _write_files(root, 'build', args.untracked)
+
+        # Files this recent always count as modified.
+        time.sleep(git_handler._timestamp_slack + 0.1)
+        log = Log(sys.stderr)
+        git_handler.is_dirty(root, log)
+        with open(os.path.join(root, '.git', 'crater-status')) as fin:
+            t = json.load(fin)['time'] - git_handler._timestamp_slack
+
+        print('{:<10} {:>10}'.format('impl', 'time [ms]'))
+        for name, fn in (('legacy', lambda: _legacy_tree_changed_since(root, t)), ('crater', lambda: git_handler.is_dirty(root, log))):
+            print('{:<10} {:>10.2f}'.format(name, _measure(fn, args.repeat) * 1000))
+    finally:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+import os, errno, six, shutil, hashlib, tempfile, threading, json, tarfile, zipfile, posixpath
+from .fsutil import set_default_mode
+from . import trace
+
+archive_formats = ('zip', 'tar')
+
+_suffixes = (
+    ('.zip', 'zip'),
+    ('.tar', 'tar'),
+    ('.tar.gz', 'tar'),
+    ('.tgz', 'tar'),
+    ('.tar.bz2', 'tar'),
+    ('.tbz2', 'tar'),
+    ('.tar.xz', 'tar'),
+    ('.txz', 'tar'),
+    )
+
+# The file in an extracted crate remembering what was extracted there.
+_marker_name = '.crater-archive'
+
+_chunk_size = 64 * 1024
+
+def _url_path(url):
+    return six.moves.urllib.parse.urlparse(url).path
+
+def _candidate_path(path):
+    # Where `fetch` leaves a download that may become the crate's next version.
+    parent, name = os.path.split(os.path.abspath(path))
+    return os.path.join(parent, '.{}.crater-new'.format(name))
+
+def _replace_dir(src, dst):
+    parent = os.path.dirname(dst)
+    if os.path.lexists(dst):
+        old = tempfile.mkdtemp(dir=parent, prefix='.crater-')
+        os.rename(dst, os.path.join(old, 'old'))
+        os.rename(src, dst)
+        shutil.rmtree(old)
+    else:
+        os.rename(src, dst)
+
+def guess_format(url):
+    path = _url_path(url).lower()
+    for suffix, format in _suffixes:
+        if path.endswith(suffix):
+            return format
+    return None
+
+class ArchiveRemote:
+    def __init__(self, url, format=None):
+        self.url = url
+
+        # Not a part of the remote's identity; when None,
+        # the format is guessed from the url.
+        if format is not None and format not in archive_formats:
+            raise RuntimeError('unknown archive format: {}'.format(format))
+        self.format = format
+
+    def archive_format(self):
+        r = self.format or guess_format(self.url)
+        if r is None:
+            raise RuntimeError('can\'t tell the archive format of {}, please specify it'.format(self.url))
+        return r
+
+    def name_hint(self):
+        hint = posixpath.basename(_url_path(self.url).rstrip('/'))
+        lower = hint.lower()
+        for suffix, _ in _suffixes:
+            if lower.endswith(suffix):
+                return hint[:-len(suffix)]
+        return hint
+
+    def __eq__(self, rhs):
+        if not isinstance(rhs, ArchiveRemote):
+            return False
+        return self.url == rhs.url
+
+    def __hash__(self):
+        return hash(self.url)
+
+class ArchiveVersion:
+    def __init__(self, sha256):
+        self.sha256 = sha256
+
+    def __eq__(self, rhs):
+        if not isinstance(rhs, ArchiveVersion):
+            return False
+        return self.sha256 == rhs.sha256
+
+    def __hash__(self):
+        return hash(self.sha256)
+
+# A file-like object over the chunks of a download, hashing them as they're read.
+class _HashingReader:
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buf = b''
+        self._hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._hash.update(chunk)
+            self._buf += chunk
+
+        if size < 0:
+            r, self._buf = self._buf, b''
+        else:
+            r, self._buf = self._buf[:size], self._buf[size:]
+        return r
+
+    def hexdigest(self):
+        # Whatever follows the end of the archive still counts.
+        while self.read(_chunk_size):
+            pass
+        return self._hash.hexdigest()
+
+def _check_member_name(name):
+    parts = name.replace('\\', '/').split('/')
+    if name.startswith(('/', '\\')) or (parts and ':' in parts[0]) or '..' in parts:
+        raise RuntimeError('refusing to extract {} outside of the crate'.format(name))
+
+def _extract_tar(fileobj, dir):
+    # Stream mode reads the archive front to back, so it can be
+    # extracted while it downloads.
+    kw = { 'filter': 'data' } if hasattr(tarfile, 'data_filter') else {}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+        for member in tf:
+            _check_member_name(member.name)
+            if member.islnk() or (member.issym() and not kw):
+                _check_member_name(member.linkname)
+            tf.extract(member, dir, **kw)
+
+def _extract_zip(fileobj, dir):
+    with zipfile.ZipFile(fileobj) as zf:
+        for info in zf.infolist():
+            _check_member_name(info.filename)
+            path = zf.extract(info, dir)
+
+            # Keep the executable bits of archives made on unix.
+            mode = (info.external_attr >> 16) & 0o777
+            if mode and not info.filename.endswith('/'):
+                os.chmod(path, mode)
+
+class ArchiveHandler:
+    # Zip archives keep their index at the end, so they can't be
+    # extracted while downloading. Smaller ones are buffered in memory.
+    zip_spool_size = 64 * 1024 * 1024
+
+    # Seconds to wait for the server to connect and to send more data.
+    timeout = 60
+
+    def __init__(self):
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+
+    def _session(self, url):
+        # Archives from the same host share a session and with it
+        # a pool of kept-alive connections.
+        parts = six.moves.urllib.parse.urlparse(url)
+        key = parts.scheme, parts.netloc
+        with self._sessions_lock:
+            r = self._sessions.get(key)
+            if r is None:
+                import requests
+                r = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16)
+                r.mount('{}://{}'.format(*key), adapter)
+                self._sessions[key] = r
+            return r
+
+    def close(self):
+        with self._sessions_lock:
+            sessions = list(six.itervalues(self._sessions))
+            self._sessions.clear()
+
+        for session in sessions:
+            session.close()
+
+    def _read_marker(self, path):
+        try:
+            with open(os.path.join(path, _marker_name), 'r') as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+    def download(self, remote, path, log, sha256=None, marker=None):
+        # Extracts the archive into `path` and returns its SHA-256. If it doesn't
+        # match `sha256`, `path` is left untouched. Given the marker of an earlier
+        # download, returns None when the server says the archive is unchanged.
+        format = remote.archive_format()
+
+        headers = {}
+        if marker is not None and marker.get('url') == remote.url:
+            if marker.get('etag'):
+                headers['If-None-Match'] = marker['etag']
+            if marker.get('last_modified'):
+                headers['If-Modified-Since'] = marker['last_modified']
+
+        parent = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        log.write('Downloading {}...\n'.format(remote.url))
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.crater-')
+        try:
+            set_default_mode(tmp, is_dir=True)
+            with trace.span('download', url=remote.url):
+                r = self._session(remote.url).get(remote.url, headers=headers, stream=True, timeout=self.timeout)
+                try:
+                    if headers and r.status_code == 304:
+                        shutil.rmtree(tmp)
+                        return None
+
+                    r.raise_for_status()
+                    reader = _HashingReader(r.iter_content(_chunk_size))
+                    if format == 'tar':
+                        _extract_tar(reader, tmp)
+                    else:
+                        with tempfile.SpooledTemporaryFile(self.zip_spool_size) as spool:
+                            shutil.copyfileobj(reader, spool, _chunk_size)
+                            _extract_zip(spool, tmp)
+                    digest = reader.hexdigest()
+                finally:
+                    r.close()
+
+            if sha256 is not None and digest != sha256.lower():
+                raise RuntimeError('the archive {} has SHA-256 {}, expected {}'.format(remote.url, digest, sha256))
+
+            # The validators let the next fetch ask for the archive only if it changed.
+            new_marker = { 'url': remote.url, 'sha256': digest }
+            if r.headers.get('ETag'):
+                new_marker['etag'] = r.headers['ETag']
+            if r.headers.get('Last-Modified'):
+                new_marker['last_modified'] = r.headers['Last-Modified']
+            with open(os.path.join(tmp, _marker_name), 'w') as fout:
+                json.dump(new_marker, fout)
+
+            _replace_dir(tmp, os.path.abspath(path))
+        except:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+
+        return digest
+
+    def fetch(self, remote, path, dep_spec, log):
+        # The url may serve new content by now; keep it next to the crate,
+        # so that an upgrade can read its DEPS and check it out.
+        candidate = _candidate_path(path)
+        if dep_spec.sha256 is not None:
+            ver = ArchiveVersion(dep_spec.sha256)
+            if self.is_checked_out(path, ver) or self.is_checked_out(candidate, ver):
+                return
+
+        marker = self._read_marker(candidate) or self._read_marker(path)
+        digest = self.download(remote, candidate, log, dep_spec.sha256, marker)
+
+        current = self.current_version(path, log)
+        if digest is not None and current is not None and current.sha256 == digest:
+            shutil.rmtree(candidate)
+
+    def prefetch(self, remote, path, ver, dep_spec, log):
+        # Archives are downloaded when a checkout or an upgrade needs them.
+        return []
+
+    def versions(self, path, dep_spec, log):
+        # There is no history to choose from, only what the url served
+        # when it was last fetched and what is extracted now.
+        if dep_spec.sha256 is not None:
+            return [ArchiveVersion(dep_spec.sha256)]
+
+        r = []
+        for ver in (self.current_version(_candidate_path(path), log), self.current_version(path, log)):
+            if ver is not None and ver not in r:
+                r.append(ver)
+        return r
+
+    def is_compatible_ver(self, path, log, ver, ds):
+        return ds.sha256 is None or ds.sha256 == ver.sha256
+
+    def is_checked_out(self, path, ver):
+        marker = self._read_marker(path)
+        return marker is not None and marker.get('sha256') == ver.sha256
+
+    def checkout(self, remote, ver, path, log):
+        candidate = _candidate_path(path)
+        if not self.is_checked_out(path, ver):
+            if self.is_checked_out(candidate, ver):
+                _replace_dir(candidate, os.path.abspath(path))
+            else:
+                self.download(remote, path, log, ver.sha256)
+
+        if os.path.isdir(candidate):
+            shutil.rmtree(candidate)
+
+    def current_version(self, path, log):
+        marker = self._read_marker(path)
+        if marker is None:
+            return None
+        return ArchiveVersion(marker['sha256'])
+
+    def is_dirty(self, path, log):
+        # Extracted archives aren't meant to be modified.
+        return False
+
+    def get_deps_file(self, path, ver, log):
+        if not self.is_checked_out(path, ver):
+            if not self.is_checked_out(_candidate_path(path), ver):
+                raise RuntimeError('the archive {} is neither extracted in {} nor served at its url'.format(ver.sha256, path))
+            path = _candidate_path(path)
+
+        try:
+            with open(os.path.join(path, 'DEPS'), 'r') as fin:
+                return fin.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return '{}'
+
+    def cache_key(self, remote, ver):
+        return 'archive\0{}\0{}'.format(remote.url, ver.sha256)
+
+    def save_lock(self, remote, ver):
+        r = {
+            'type': 'archive',
+            'url': remote.url,
+            'sha256': ver.sha256,
+            }
+        if remote.format is not None:
+            r['format'] = remote.format
+        return r
+
+    def load_lock(self, spec):
+        return ArchiveRemote(spec['url'], spec.get('format')), ArchiveVersion(spec['sha256'])
+
+    def load_depspec(self, spec):
+        return ArchiveRemote(spec['url'], spec.get('format')), ArchiveDepSpec(spec.get('sha256'))
+
+    def empty_dep_spec(self):
+        return ArchiveDepSpec(None)
+
+class ArchiveDepSpec:
+    def __init__(self, sha256):
+        self.sha256 = sha256.lower() if sha256 is not None else None
+
+    def init(self, path, remote, log):
+        digest = archive_handler.download(remote, path, log, self.sha256)
+        return archive_handler, ArchiveVersion(digest)
+
+    def join(self, o):
+        if not isinstance(o, ArchiveDepSpec):
+            return None
+
+        if self.sha256 is None:
+            return o
+        if o.sha256 is None or o.sha256 == self.sha256:
+            return self
+        return None
+
+archive_handler = ArchiveHandler()
@@ -0,0 +1,134 @@
+import os, sys, json, threading, time
+
+def user_cache_dir():
+    # CRATER_CACHE_DIR overrides the location; an empty one disables the caches.
+    r = os.environ.get('CRATER_CACHE_DIR')
+    if r is not None:
+        return r or None
+
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+
+    return os.path.join(base, 'crater')
+
+# A JSON key-value store in sqlite, shared by concurrent processes. Past
+# `max_size` bytes, the least recently used entries are evicted. Database
+# errors only make lookups miss and drop stores.
+class DiskCache:
+    def __init__(self, path, table, max_size):
+        self._path = path
+        self._table = table
+        self._max_size = max_size
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import sqlite3
+        if self._conn is None:
+            dir = os.path.dirname(self._path)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+
+            conn = sqlite3.connect(self._path, timeout=10, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS {} (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)'.format(self._table))
+            conn.execute('CREATE INDEX IF NOT EXISTS {0}_atime ON {0} (atime)'.format(self._table))
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key):
+        import sqlite3
+        with self._lock:
+            try:
+                conn = self._connect()
+                row = conn.execute('SELECT value, atime FROM {} WHERE key = ?'.format(self._table), (key,)).fetchone()
+                if row is None:
+                    return None
+
+                # The eviction order doesn't need to be exact; refreshing
+                # the access time at most once an hour keeps lookups from
+                # turning into writes.
+                now = time.time()
+                if now - row[1] > 3600:
+                    conn.execute('UPDATE {} SET atime = ? WHERE key = ?'.format(self._table), (now, key))
+                    conn.commit()
+            except (sqlite3.Error, OSError):
+                return None
+
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        import sqlite3
+        value = json.dumps(value, sort_keys=True)
+
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute('INSERT OR REPLACE INTO {} (key, value, size, atime) VALUES (?, ?, ?, ?)'.format(self._table),
+                    (key, value, len(key) + len(value), time.time()))
+                self._evict(conn)
+                conn.commit()
+            except (sqlite3.Error, OSError):
+                pass
+
+    def _evict(self, conn):
+        total, = conn.execute('SELECT total(size) FROM {}'.format(self._table)).fetchone()
+        if total <= self._max_size:
+            return
+
+        # Evict down to 3/4 of the limit, so that we don't have to evict
+        # again on the very next store.
+        excess = total - self._max_size * 3 // 4
+        doomed = []
+        for key, size in conn.execute('SELECT key, size FROM {} ORDER BY atime'.format(self._table)):
+            if excess <= 0:
+                break
+            doomed.append((key,))
+            excess -= size
+
+        conn.executemany('DELETE FROM {} WHERE key = ?'.format(self._table), doomed)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def open_cache(table, max_size):
+    # None if caching is disabled.
+    dir = user_cache_dir()
+    if dir is None:
+        return None
+
+    path = os.path.join(dir, 'cache.sqlite')
+    with _caches_lock:
+        r = _caches.get((path, table))
+        if r is None:
+            r = DiskCache(path, table, max_size)
+            _caches[path, table] = r
+        return r
+
+def deps_cache():
+    # Dependency specs of DEPS files, keyed by `handler.cache_key(remote, ver)`.
+    return open_cache('deps', 64 * 1024 * 1024)
+
+def compiled_deps_cache():
+    # Parsed DEPS files in JSON form, keyed by the SHA-1 of their content.
+    return open_cache('compiled_deps', 64 * 1024 * 1024)
+
+def deps_files_cache():
+    # The size, mtime and content hash of DEPS files in working trees, by path.
+    return open_cache('deps_files', 4 * 1024 * 1024)
+
+def fetch_times_cache():
+    # When each remote was last fetched into each repository.
+    return open_cache('fetch_times', 4 * 1024 * 1024)
@@ -8,9 +8,11 @@ import subprocess
 import six
 
 from .log import Log
-from .lockfile import parse_lockfile
-from .gitcrate import GitRemote, GitDepSpec
+from .lockfile import parse_lockfile, get_handler
+from .gitcrate import GitRemote, GitDepSpec, git_handler, clone_modes, git_backends, clear_git_env
 from .gen import gen
+from .pool import run_jobs, default_jobs
+from . import trace
 
 def _init(lock):
     if not lock.is_empty():
@@ -20,38 +22,73 @@ def _init(lock):
     lock.save(force=True)
     return 0
 
-def _checkout(lock):
-    for crate in lock.crates():
-        crate.checkout()
+def _checkout_digest(lock, generated):
+    # The lockfile pins every crate's version and the root DEPS holds
+    # the gen statements for the root; together they determine
+    # the outcome of a checkout. The files generated last time must
+    # also still be there, unmodified.
+    import hashlib
+    h = hashlib.sha1()
+    for name in ('.deps.lock', 'DEPS') + tuple(generated):
+        try:
+            with open(os.path.join(lock.root(), name), 'rb') as fin:
+                h.update(fin.read())
+        except IOError:
+            pass
+        h.update(b'\0')
+    return h.hexdigest()
+
+def _checkout(lock, jobs):
+    # Git hooks run this on every branch switch; if the lockfile didn't
+    # change since the last checkout and all crates are still
+    # on their locked versions, there is nothing to do.
+    state = lock.load_state('checkout')
+    generated = state.get('generated', []) if isinstance(state, dict) else []
+    if state == { 'digest': _checkout_digest(lock, generated), 'generated': generated } and all(crate.is_checked_out() for crate in lock.crates()):
+        return 0
+
+    def checkout_one(crate, log):
+        crate.checkout(log=log)
         crate.reload_deps()
 
-        mapping = { 'self': os.path.abspath(crate.path) }
-        for dep, target in crate.deps():
-            mapping[dep] = os.path.abspath(target.path)
+    failed = False
+    for crate, _, e in run_jobs(checkout_one, lock.crates(), lock.log, jobs):
+        if e is not None:
+            lock.log.error('failed to check out {}: {}'.format(crate.name or '.', e))
+            failed = True
 
-    gen(lock)
+    if failed:
+        return 1
+
+    generated = sorted(os.path.relpath(path, lock.root()) for path in gen(lock))
+    lock.save_state('checkout', { 'digest': _checkout_digest(lock, generated), 'generated': generated })
     return 0
 
 def _gen(lock):
     gen(lock)
     return 0
 
-def _commit(lock, force):
-    for crate in lock.crates():
-        if not force and crate.is_dirty():
-            lock.log.error('crate {} has uncommitted changes (use "crater commit --force" and then "git commit --no-verify" to override)'.format(crate.name))
-            return 1
+def _commit(lock, force, jobs):
+    if not force:
+        for crate, dirty, e in run_jobs(lambda crate, log: crate.is_dirty(log), lock.crates(), lock.log, jobs):
+            if e is not None:
+                raise e
+            if dirty:
+                lock.log.error('crate {} has uncommitted changes (use "crater commit --force" and then "git commit --no-verify" to override)'.format(crate.name))
+                return 1
 
+    for crate in lock.crates():
         crate.update()
 
     lock.save()
     return 0
 
-def _status(lock):
-    for crate in lock.crates():
-        if crate.is_self_crate():
-            continue
-        print('{} {}'.format(crate.status(), crate.name))
+def _status(lock, jobs):
+    crates = [crate for crate in lock.crates() if not crate.is_self_crate()]
+    for crate, status, e in run_jobs(lambda crate, log: crate.status(log), crates, lock.log, jobs):
+        if e is not None:
+            raise e
+        print('{} {}'.format(status, crate.name))
 
     return 0
 
@@ -93,70 +130,55 @@ def _upgrade(lock, depid, target_dir, dir):
 
     dir = lock.guess_deps_dir(dir)
 
-    remotes = {}
-    for crate in lock.crates():
-        remotes.setdefault(crate.remote(), set()).add(crate)
+    # Crates cloned by an interrupted upgrade are still on the disk.
+    lock.resume()
 
     targets = {}
 
     fetched_crates = set()
 
-    def lock_one(unlocked, locked):
-        if not unlocked:
-            return locked
-
-        locked = dict(locked)
-        unlocked = dict(unlocked)
-
-        c = next(iter(unlocked))
-        dep_spec = unlocked[c]
-        del unlocked[c]
-
-        for ver in c.versions(dep_spec):
-            locked[c] = ver
-
-            new_dep_specs = c.get_dep_specs(ver)
-            for dep_name, (remote, ds) in six.iteritems(new_dep_specs):
-                tgt = c.get_dep(dep_name)
-                if tgt is None:
-                    tgt = remotes.get(remote)
-                    if tgt is None:
-                        name = lock.new_unique_crate_name(remote, dir)
-                        tgt = lock.init_crate(remote, ds, name)
-                        c.set_dep(dep_name, tgt)
-                        lock.save()
-                        remotes.setdefault(remote, set()).add(tgt)
-                    elif len(tgt) == 1:
-                        tgt = next(iter(tgt))
-                        c.set_dep(dep_name, tgt)
-                    else:
-                        # Can't associate, skip this dep
-                        # XXX write a warning to the log
-                        continue
+    def versions(c, dep_spec):
+        return c.versions(dep_spec)
+
+    def dependencies(c, ver):
+        r = []
+
+        new_dep_specs = c.get_dep_specs(ver)
+        for dep_name, (remote, ds) in six.iteritems(new_dep_specs):
+            tgt = c.get_dep(dep_name)
+            if tgt is None:
+                tgt = lock.crates_with_remote(remote)
+                if not tgt:
+                    name = lock.new_unique_crate_name(remote, dir)
+                    tgt = lock.init_crate(remote, ds, name)
+                    c.set_dep(dep_name, tgt)
+                elif len(tgt) == 1:
+                    tgt = next(iter(tgt))
+                    c.set_dep(dep_name, tgt)
                 else:
-                    if tgt not in fetched_crates:
-                        fetched_crates.add(tgt)
-                        tgt.fetch()
-
-                targets[c, dep_name] = tgt
-                if tgt in locked:
-                    if not tgt.is_compatible_ver(locked[tgt], ds):
-                        return
-                elif tgt in unlocked:
-                    ds = unlocked[tgt].join(ds)
-                    if ds is None:
-                        return
-                    unlocked[tgt] = ds
-                else:
-                    unlocked[tgt] = ds
+                    # Can't associate, skip this dep
+                    # XXX write a warning to the log
+                    continue
+            else:
+                if tgt not in fetched_crates:
+                    fetched_crates.add(tgt)
+                    tgt.fetch(ds)
+
+            targets[c, dep_name] = tgt
+            r.append((tgt, ds))
+
+        return r
 
-            r = lock_one(unlocked, locked)
-            if r is not None:
-                return r
+    def is_compatible(c, ver, ds):
+        return c.is_compatible_ver(ver, ds)
 
+    from .solver import solve
     self_crate = lock.get_crate('')
-    unlocked_crates = { self_crate : self_crate.empty_dep_spec() }
-    r = lock_one(unlocked_crates, locked={})
+    with trace.span('solve'):
+        r = solve(self_crate, self_crate.empty_dep_spec(), versions, dependencies, is_compatible)
+    if r is None:
+        lock.log.error('there is no set of versions satisfying all the dependencies')
+        return 1
 
     for (c, dep_name), tgt in six.iteritems(targets):
         c.set_dep(dep_name, tgt)
@@ -167,6 +189,60 @@ def _upgrade(lock, depid, target_dir, dir):
     lock.save()
 
     gen(lock)
+    return 0
+
+def _prefetch(lock, jobs):
+    # Fetches the remotes of the locked crates and of the dependency specs
+    # reachable from them, in rounds, as the DEPS files of the fetched
+    # versions reveal more remotes. Neither the working trees nor
+    # the lockfile change.
+    from .depsfile import load_deps, parse_deps
+
+    # The remotes seen in dependency specs, with their handlers
+    # and the join of the specs.
+    wanted = {}
+
+    def want(d):
+        for spec in six.itervalues(d.get('dependencies', {})):
+            handler = get_handler(spec['type'])
+            remote, ds = handler.load_depspec(spec)
+            if remote in wanted:
+                prev = wanted[remote][1]
+                ds = prev.join(ds) or prev
+            wanted[remote] = handler, ds
+
+    for crate in lock.crates():
+        try:
+            want(load_deps(os.path.join(crate.path, 'DEPS')))
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def prefetch_one(item, log):
+        crate, handler, remote = item
+        ds = wanted.get(remote, (None, None))[1]
+        if crate is not None:
+            return crate.prefetch(ds, log)
+        return handler.prefetch(remote, None, None, ds, log)
+
+    items = [(crate, None, crate.remote()) for crate in lock.crates() if not crate.is_self_crate()]
+    done = set(crate.remote() for crate in lock.crates())
+
+    failed = False
+    while items:
+        for (crate, _, remote), deps_files, e in run_jobs(prefetch_one, items, lock.log, jobs):
+            if e is not None:
+                lock.log.error('failed to prefetch {}: {}'.format(crate.name if crate is not None else remote.url, e))
+                failed = True
+                continue
+
+            for deps_file in deps_files:
+                want(parse_deps(deps_file.encode('utf-8')))
+
+        items = [(None, handler, remote) for remote, (handler, _) in six.iteritems(wanted) if remote not in done]
+        done.update(remote for _, _, remote in items)
+
+    return 1 if failed else 0
 
 def _list_deps(lock):
     r = []
@@ -189,7 +265,7 @@ def _assign(lock, dep, crate, force):
 
     crate = lock.locate_crate(cname)
 
-    if dname not in crate._dep_specs:
+    if crate.get_dep_spec(dname) is None:
         if not force:
             print('error: the dependency {} has no specification in the DEPS file'.format(dep), file=sys.stderr)
             return 1
@@ -223,7 +299,7 @@ def _add_git_crate(lock, url, target, branch, quiet):
 
     dep_name = os.path.split(target)[1]
     for crate in lock.crates():
-        if dep_name not in crate._deps and dep_name in crate._dep_specs:
+        if crate.get_dep(dep_name) is None and crate.get_dep_spec(dep_name) is not None:
             crate.set_dep(dep_name, new_crate)
 
     lock.save()
@@ -255,6 +331,12 @@ def find_root(dir):
 def _main(argv, log):
     ap = argparse.ArgumentParser()
     ap.add_argument('--root')
+    ap.add_argument('--mirror-dir')
+    ap.add_argument('--store-dir')
+    ap.add_argument('--clone', choices=clone_modes)
+    ap.add_argument('--fetch-window', type=float, metavar='SECONDS')
+    ap.add_argument('--git-backend', choices=git_backends)
+    ap.add_argument('--trace', metavar='FILE')
     sp = ap.add_subparsers()
 
     p = sp.add_parser('init')
@@ -262,11 +344,13 @@ def _main(argv, log):
 
     for cmd in ('checkout', 'co'):
         p = sp.add_parser(cmd)
+        p.add_argument('--jobs', '-j', type=int, default=1)
         p.set_defaults(fn=_checkout)
 
     for cmd in ('commit', 'ci'):
         p = sp.add_parser(cmd)
         p.add_argument('-f', '--force', action='store_true')
+        p.add_argument('--jobs', '-j', type=int, default=default_jobs())
         p.set_defaults(fn=_commit)
 
     p = sp.add_parser('add-git')
@@ -292,6 +376,7 @@ def _main(argv, log):
 
     for cmd in ('st', 'status'):
         p = sp.add_parser(cmd)
+        p.add_argument('--jobs', '-j', type=int, default=default_jobs())
         p.set_defaults(fn=_status)
 
     p = sp.add_parser('deps')
@@ -303,6 +388,10 @@ def _main(argv, log):
     p.add_argument('target_dir', nargs='?')
     p.set_defaults(fn=_upgrade)
 
+    p = sp.add_parser('prefetch')
+    p.add_argument('--jobs', '-j', type=int, default=default_jobs())
+    p.set_defaults(fn=_prefetch)
+
     p = sp.add_parser('gen')
     p.set_defaults(fn=_gen)
 
@@ -314,9 +403,51 @@ def _main(argv, log):
     root = args.root or find_root('.')
     del args.root
 
-    lock = parse_lockfile(root, log)
-
-    return fn(lock=lock, **vars(args))
+    # For whatever reason, git calls are not reentrant.
+    clear_git_env()
+
+    git_handler.mirror_dir = args.mirror_dir or os.environ.get('CRATER_MIRROR_DIR') or None
+    del args.mirror_dir
+
+    # The crates are symlinks to the store, which mustn't depend on the current directory.
+    store_dir = args.store_dir or os.environ.get('CRATER_STORE_DIR')
+    git_handler.store_dir = os.path.abspath(store_dir) if store_dir else None
+    del args.store_dir
+
+    git_handler.clone_mode = args.clone
+    del args.clone
+
+    fetch_window = args.fetch_window
+    if fetch_window is None:
+        fetch_window = float(os.environ.get('CRATER_FETCH_WINDOW') or 0)
+    git_handler.fetch_window = fetch_window
+    del args.fetch_window
+
+    backend = args.git_backend or os.environ.get('CRATER_GIT_BACKEND') or 'git'
+    if backend not in git_backends:
+        log.error('unknown git backend: {}'.format(backend))
+        return 2
+    git_handler.backend = backend
+    del args.git_backend
+
+    trace_path = args.trace
+    del args.trace
+
+    # Spans are recorded in the Chrome trace event format,
+    # ready for chrome://tracing or Perfetto.
+    tracer = trace.start() if trace_path else None
+    try:
+        with trace.span('parse lockfile'):
+            lock = parse_lockfile(root, log)
+        try:
+            with trace.span(fn.__name__.lstrip('_'), argv=argv), lock.transaction():
+                return fn(lock=lock, **vars(args))
+        finally:
+            lock.close()
+    finally:
+        if tracer is not None:
+            trace.stop()
+            tracer.save(trace_path)
 
 def main():
     return _main(sys.argv[1:], Log(sys.stderr))
@@ -0,0 +1,49 @@
+import os, hashlib, time
+from .cache import compiled_deps_cache, deps_files_cache
+
+# Files modified this recently may still change without their size
+# or timestamp changing; their stat data is not trusted.
+_racy_interval = 2
+
+def parse_deps(data):
+    # CSON parsing is slow, so the result is cached by the hash of the content.
+    return _parse(data, hashlib.sha1(data).hexdigest())
+
+def _parse(data, digest):
+    cache = compiled_deps_cache()
+    if cache is not None:
+        d = cache.get(digest)
+        if d is not None:
+            return d
+
+    import cson
+    d = cson.loads(data.decode('utf-8'))
+    if cache is not None:
+        cache.put(digest, d)
+    return d
+
+def load_deps(path):
+    # The file isn't even read if its size and mtime are as last seen.
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = [st.st_size, st.st_mtime]
+
+    files = deps_files_cache()
+    compiled = compiled_deps_cache()
+    if files is not None and compiled is not None:
+        entry = files.get(path)
+        if entry is not None and entry['stat'] == stat_key:
+            d = compiled.get(entry['digest'])
+            if d is not None:
+                return d
+
+    with open(path, 'rb') as fin:
+        data = fin.read()
+
+    digest = hashlib.sha1(data).hexdigest()
+    d = _parse(data, digest)
+
+    if files is not None and time.time() - st.st_mtime > _racy_interval:
+        files.put(path, { 'stat': stat_key, 'digest': digest })
+
+    return d
@@ -0,0 +1,12 @@
+import os
+
+# Reading the umask means changing it for the whole process, which
+# mustn't happen while other threads create files. It is read once
+# here; crater.crater imports this module before starting any threads.
+_umask = os.umask(0)
+os.umask(_umask)
+
+def set_default_mode(path, is_dir=False):
+    # mkstemp and mkdtemp create files only the owner can read;
+    # give them the permissions a plain open or mkdir would.
+    os.chmod(path, (0o777 if is_dir else 0o666) & ~_umask)
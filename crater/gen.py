@@ -1,4 +1,44 @@
-import os, toposort
+import os, errno, tempfile
+from .fsutil import set_default_mode
+from . import trace
+
+def _replace(src, dst):
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        try:
+            os.rename(src, dst)
+        except OSError as e:
+            # Windows won't rename over an existing file.
+            if e.errno != errno.EEXIST:
+                raise
+            os.remove(dst)
+            os.rename(src, dst)
+
+def write_if_changed(path, content):
+    # Rewriting unchanged generated files would trigger rebuilds. The file is
+    # replaced atomically; returns True if it was written.
+    try:
+        with open(path, 'rb') as fin:
+            if fin.read() == content:
+                return False
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    dir, name = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(dir=dir or '.', prefix='.{}.'.format(name))
+    try:
+        with os.fdopen(fd, 'wb') as fout:
+            fout.write(content)
+        set_default_mode(tmp)
+
+        _replace(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+    return True
 
 def gen_msbuild(path, mapping, g):
     templ = '''\
@@ -12,18 +52,19 @@ def gen_msbuild(path, mapping, g):
     file = g.get('file', 'deps.props')
 
     deps = []
-    for name, target_dir in mapping.items():
+    for name, target_dir in sorted(mapping.items()):
         deps.append('    <{prefix}{name}>{dir}</{prefix}{name}>\n'.format(prefix=prefix, name=name, dir=target_dir))
 
     content = templ.format(deps=''.join(deps))
-    with open(os.path.join(path, file), 'wb') as fout:
-        fout.write(content.encode())
+    path = os.path.join(path, file)
+    write_if_changed(path, content.encode())
+    return path
 
 def gen_cmake(mapping, g):
     prefix = g.get('prop_prefix', 'dep_')
 
     deps = []
-    for name, target_dir in mapping.items():
+    for name, target_dir in sorted(mapping.items()):
         if name != 'self':
             deps.append('set({prefix}{name} {dir})\n'.format(prefix=prefix, name=name, dir=target_dir))
 
@@ -37,12 +78,20 @@ def topo_sort_crates(lock):
         deps = set(tgt for name, tgt in crate.deps())
         spec[crate] = deps
 
+    # Sort each chunk, so that the output is the same on every run.
+    import toposort
     r = []
     for chunk in toposort.toposort(spec):
-        r.extend(chunk)
+        r.extend(sorted(chunk, key=lambda crate: crate.name))
     return r
 
 def gen(lock):
+    # Returns the paths of the generated files.
+    with trace.span('gen'):
+        return _gen(lock)
+
+def _gen(lock):
+    r = []
     for crate in lock.crates():
         g = crate.gen_stmts()
         d = g.get('msbuild')
@@ -53,7 +102,7 @@ def gen(lock):
         for dep, target in crate.deps():
             mapping[dep] = os.path.abspath(target.path)
 
-        gen_msbuild(crate.path, mapping, d)
+        r.append(gen_msbuild(crate.path, mapping, d))
 
     for crate in lock.crates():
         g = crate.gen_stmts()
@@ -75,6 +124,8 @@ def gen(lock):
                     content.append('add_subdirectory({dep_path} EXCLUDE_FROM_ALL)\n'.format(dep_path=os.path.relpath(c.path, crate.path).replace('\\', '/')))
 
         if content:
-            with open(os.path.join(crate.path, g.get('file', 'deps.cmake')), 'wb') as fout:
-                content = ''.join(content)
-                fout.write(content.encode())
+            path = os.path.join(crate.path, g.get('file', 'deps.cmake'))
+            write_if_changed(path, ''.join(content).encode())
+            r.append(path)
+
+    return r
@@ -1,10 +1,21 @@
-import os, errno, sys, six, shutil, stat
+import os, errno, sys, six, shutil, stat, threading, tempfile, subprocess, json, time
 from .log import CalledProcessError
+from .fsutil import set_default_mode
+from . import trace
+
+clone_modes = ('full', 'partial', 'shallow')
+git_backends = ('git', 'python')
 
 class GitRemote:
-    def __init__(self, url):
+    def __init__(self, url, clone=None):
         self.url = url
 
+        # How to clone the remote, one of `clone_modes`, or None
+        # to use the default. Not a part of the remote's identity.
+        if clone is not None and clone not in clone_modes:
+            raise RuntimeError('unknown clone mode: {}'.format(clone))
+        self.clone = clone
+
     def name_hint(self):
         hint = self.url.replace('\\', '/').rsplit('/', 1)[-1]
         if hint.endswith('.git'):
@@ -31,47 +42,655 @@ class GitVersion:
     def __hash__(self):
         return hash(self.hash)
 
+def _rmtree(path):
+    def readonly_handler(rm_func, path, exc_info):
+        if issubclass(exc_info[0], OSError) and getattr(exc_info[1], 'winerror', None) == 5:
+            os.chmod(path, stat.S_IWRITE)
+            return rm_func(path)
+        raise exc_info[1]
+    shutil.rmtree(path, onerror=readonly_handler)
+
+def _make_read_only(path):
+    # Only the working tree; git still needs to update the index.
+    for dir, dirs, files in os.walk(path):
+        if dir == path and '.git' in dirs:
+            dirs.remove('.git')
+        for name in files:
+            fname = os.path.join(dir, name)
+            st = os.lstat(fname)
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(fname, stat.S_IMODE(st.st_mode) & ~0o222)
+
+def _link_tree(src, dst):
+    # Git replaces files rather than writing into them, so hard links
+    # to the store are safe; files are copied where links can't be made.
+    for dir, dirs, files in os.walk(src):
+        if dir == src and '.git' in dirs:
+            dirs.remove('.git')
+        target = os.path.join(dst, os.path.relpath(dir, src))
+        if not os.path.isdir(target):
+            os.mkdir(target)
+        for name in dirs + files:
+            fname = os.path.join(dir, name)
+            if os.path.islink(fname):
+                os.symlink(os.readlink(fname), os.path.join(target, name))
+            elif name in files:
+                try:
+                    os.link(fname, os.path.join(target, name))
+                except (AttributeError, OSError):
+                    shutil.copy2(fname, os.path.join(target, name))
+
+def read_head(git_dir):
+    # None if reading HEAD needs git's help.
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'rb') as fin:
+            head = fin.read().strip()
+    except IOError:
+        return None
+
+    if not head.startswith(b'ref: '):
+        return head.decode() if len(head) == 40 else None
+
+    ref = head[5:].strip()
+    try:
+        with open(os.path.join(git_dir, ref.decode()), 'rb') as fin:
+            commit = fin.read().strip()
+        return commit.decode() if len(commit) == 40 else None
+    except IOError:
+        pass
+
+    try:
+        with open(os.path.join(git_dir, 'packed-refs'), 'rb') as fin:
+            for line in fin:
+                toks = line.split()
+                if len(toks) == 2 and toks[1] == ref and len(toks[0]) == 40:
+                    return toks[0].decode()
+    except IOError:
+        pass
+
+    return None
+
+def _stat_key(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime, st.st_size]
+
+def _files_changed_since(path, files, t):
+    # Returns True if any of the tracked `files` was modified, replaced
+    # or deleted at time `t` or later. Untracked files can't make a crate
+    # dirty, so the rest of the working tree (build outputs and the like)
+    # isn't walked. Edits in place don't touch the directories' mtimes,
+    # so each tracked file is still looked at.
+    for name in files:
+        try:
+            st = os.lstat(os.path.join(path, name))
+        except OSError:
+            return True
+        if st.st_mtime >= t or st.st_ctime >= t:
+            return True
+    return False
+
+# A long-lived `git cat-file --batch` process for a single repository.
+class _CatFile:
+    def __init__(self, path):
+        self._proc = subprocess.Popen(['git', 'cat-file', '--batch'], cwd=path,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._lock = threading.Lock()
+
+    def read(self, rev):
+        # Returns `(type, content)`, or None if there is no such object.
+        with self._lock, trace.span('git cat-file', 'subprocess', rev=rev):
+            self._proc.stdin.write(rev.encode('utf-8') + b'\n')
+            self._proc.stdin.flush()
+
+            header = self._proc.stdout.readline()
+            if not header:
+                raise RuntimeError('git cat-file exited unexpectedly')
+
+            toks = header.split()
+            if len(toks) != 3:
+                return None
+
+            size = int(toks[2])
+            chunks = []
+            while size > 0:
+                chunk = self._proc.stdout.read(size)
+                if not chunk:
+                    raise RuntimeError('git cat-file exited unexpectedly')
+                chunks.append(chunk)
+                size -= len(chunk)
+            self._proc.stdout.read(1)
+
+            return toks[1].decode(), b''.join(chunks)
+
+    def close(self):
+        self._proc.stdin.close()
+        self._proc.stdout.close()
+        self._proc.wait()
+
+# Answers the read-only queries about a repository by running git.
+class _GitBackend:
+    def __init__(self, path):
+        self.path = path
+        self._cat_file = None
+        self._lock = threading.Lock()
+
+    def read(self, rev):
+        # Returns `(type, content)`, or None if there is no such object.
+        with self._lock:
+            if self._cat_file is None:
+                self._cat_file = _CatFile(self.path)
+        return self._cat_file.read(rev)
+
+    def has_commit(self, hash, log):
+        return log.call(['git', 'rev-parse', '--quiet', '--verify', '{}^{{commit}}'.format(hash)], stdout=None, cwd=self.path) == 0
+
+    def resolve(self, rev, log):
+        # The commit `rev` names, or None.
+        try:
+            return log.check_output(['git', 'rev-parse', '--quiet', '--verify', '{}^{{commit}}'.format(rev)], cwd=self.path).decode().strip()
+        except CalledProcessError:
+            return None
+
+    def graph(self, tips, log):
+        from .gitgraph import CommitGraph
+        return CommitGraph.load(self.path, log, tips)
+
+    def history(self, rev, log, page_size, skip=0):
+        # In the order `git log rev` lists the commits.
+        # The solver usually accepts one of the first few candidates,
+        # so read the history lazily, in geometrically growing pages.
+        page = page_size
+        while True:
+            commits = log.check_output(['git', 'log', '--pretty=format:%H', '--skip={}'.format(skip), '--max-count={}'.format(page), rev], cwd=self.path).decode().split()
+            for hash in commits:
+                yield hash
+
+            if len(commits) < page:
+                return
+
+            skip += page
+            page *= 2
+
+    def invalidate(self):
+        # git itself notices new objects and refs.
+        pass
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.close()
+
+# Reads the repository files in-process; whatever the reader doesn't
+# support is passed on to git.
+class _PythonBackend(_GitBackend):
+    def __init__(self, path):
+        _GitBackend.__init__(self, path)
+        self._store = self._open_store()
+
+    def _open_store(self):
+        from .gitobjects import ObjectStore, read_errors
+        try:
+            return ObjectStore.open(self.path)
+        except read_errors:
+            return None
+
+    def read(self, rev):
+        from .gitobjects import read_errors
+        store = self._store
+        if store is not None:
+            try:
+                with trace.span('read object', rev=rev):
+                    return store.read_rev(rev)
+            except read_errors:
+                pass
+        return _GitBackend.read(self, rev)
+
+    def has_commit(self, hash, log):
+        return self.read('{}^{{commit}}'.format(hash)) is not None
+
+    def resolve(self, rev, log):
+        from .gitobjects import read_errors
+        store = self._store
+        if store is not None:
+            try:
+                hash = store.resolve(rev)
+                if hash is None:
+                    return None
+                type, hash = store.peel(hash)
+                return hash if type == 'commit' else None
+            except read_errors:
+                pass
+        return _GitBackend.resolve(self, rev, log)
+
+    def graph(self, tips, log):
+        from .gitobjects import read_errors
+        from .gitgraph import CommitGraph
+        store = self._store
+        if store is not None:
+            try:
+                with trace.span('read commit graph', path=self.path):
+                    refs, commits = store.commit_graph_input(tips)
+                return CommitGraph(refs, commits)
+            except read_errors:
+                pass
+        return _GitBackend.graph(self, tips, log)
+
+    def history(self, rev, log, page_size, skip=0):
+        from .gitobjects import read_errors
+        store = self._store
+
+        # Git takes over after the commits already listed.
+        done = 0
+        if store is not None:
+            try:
+                hash = store.resolve(rev)
+                if hash is not None:
+                    for hash in store.history(hash):
+                        if done >= skip:
+                            yield hash
+                        done += 1
+                    return
+            except read_errors:
+                pass
+
+        for hash in _GitBackend.history(self, rev, log, page_size, max(skip, done)):
+            yield hash
+
+    def invalidate(self):
+        # Fetches may have unshallowed the repository or created it.
+        old, self._store = self._store, self._open_store()
+        if old is not None:
+            old.close()
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+        _GitBackend.close(self)
+
+def clear_git_env():
+    # Keeps the repository of a git hook running crater out of its git calls.
+    for key in list(os.environ):
+        if key.startswith('GIT_') and key != 'GIT_SSH':
+            del os.environ[key]
+
 class GitHandler:
     def __init__(self):
-        # This is a workaround. For whatever reason, git calls are not reentrant.
-        for key in list(os.environ):
-            if key.startswith('GIT_') and key != 'GIT_SSH':
-                del os.environ[key]
+        # When set, every remote is cloned into a bare mirror under this
+        # directory first and crate clones borrow objects from it.
+        self.mirror_dir = None
+
+        # The clone mode for remotes that don't specify one.
+        self.clone_mode = None
+
+        # When set, each version of a remote is checked out once into
+        # a shared store under this directory, and new crates are made
+        # of hard links into it.
+        self.store_dir = None
+
+        # Seconds for which a fetch stays fresh. Remotes fetched into
+        # a repository more recently than this, even by an earlier crater
+        # process, aren't fetched again. Within a single command, every
+        # repository is fetched at most once regardless.
+        self.fetch_window = 0
+
+        # How read-only queries are answered, one of `git_backends`:
+        # by running git, or by reading the repository files in-process.
+        self.backend = 'git'
+
+        self._path_locks = {}
+        self._path_locks_lock = threading.Lock()
+
+        self._backends = {}
+        self._backends_lock = threading.Lock()
+
+        # The branch tips of each repository, and a commit graph
+        # of the history of some of them.
+        self._tips = {}
+        self._graphs = {}
+        self._deepened = set()
+        self._graphs_lock = threading.Lock()
+
+        # The (url, repository) pairs fetched by this command.
+        self._fetched = set()
+        self._fetched_lock = threading.Lock()
+
+    def _graph(self, path, tips, log):
+        # Only what's reachable from `tips`; whole repositories
+        # can be too large to load.
+        path = os.path.abspath(path)
+        tips = tuple(sorted(tips))
+        with self._graphs_lock:
+            r = self._graphs.get(path)
+        if r is None or r[0] != tips:
+            r = tips, self._backend(path).graph(tips, log)
+            with self._graphs_lock:
+                self._graphs[path] = r
+        return r[1]
+
+    def _tip(self, path, branch, log):
+        path = os.path.abspath(path)
+        with self._graphs_lock:
+            tips = self._tips.setdefault(path, {})
+            if branch in tips:
+                return tips[branch]
+        r = self._backend(path).resolve('origin/{}'.format(branch), log)
+        with self._graphs_lock:
+            tips[branch] = r
+        return r
+
+    def _invalidate_graph(self, path):
+        path = os.path.abspath(path)
+        with self._graphs_lock:
+            self._tips.pop(path, None)
+            self._graphs.pop(path, None)
+        with self._backends_lock:
+            backend = self._backends.get(path)
+        if backend is not None:
+            backend.invalidate()
+
+    def _merge_base(self, path, branches, log):
+        tips = self._track_branches(path, branches, log)
+        if len(tips) == 1 and tips[0] is not None:
+            return tips[0]
+
+        if all(tips):
+            bases = self._graph(path, tips, log).merge_bases(tips)
+            if bases is not None and len(bases) == 1:
+                return bases[0]
+
+        # Criss-cross merges have more than one best merge base;
+        # let git choose between them.
+        return log.check_output(['git', 'merge-base', '--octopus'] + ['origin/{}'.format(b) for b in branches], cwd=path).decode().strip()
+
+    def _backend(self, path):
+        path = os.path.abspath(path)
+        with self._backends_lock:
+            r = self._backends.get(path)
+            if r is None:
+                r = _PythonBackend(path) if self.backend == 'python' else _GitBackend(path)
+                self._backends[path] = r
+            return r
+
+    def close(self):
+        with self._backends_lock:
+            backends = list(six.itervalues(self._backends))
+            self._backends.clear()
+
+        for backend in backends:
+            backend.close()
+
+        with self._graphs_lock:
+            self._tips.clear()
+            self._graphs.clear()
+            self._deepened.clear()
+
+        with self._fetched_lock:
+            self._fetched.clear()
+
+    def _path_lock(self, path):
+        # Serializes the threads creating the same mirror or store entry,
+        # or fetching into the same repository;
+        # other processes are kept out by renaming the finished directory
+        # into place.
+        with self._path_locks_lock:
+            return self._path_locks.setdefault(path, threading.Lock())
+
+    def _remote_dir_name(self, remote):
+        import hashlib
+        digest = hashlib.sha1(remote.url.encode('utf-8')).hexdigest()
+        return '{}-{}'.format(remote.name_hint(), digest[:16])
+
+    def mirror_path(self, remote):
+        if not self.mirror_dir:
+            return None
+        return os.path.join(self.mirror_dir, '{}.git'.format(self._remote_dir_name(remote)))
+
+    def store_path(self, remote, ver):
+        if not self.store_dir:
+            return None
+        return os.path.join(self.store_dir, self._remote_dir_name(remote), ver.hash)
+
+    def update_mirror(self, remote, log):
+        mirror = self.mirror_path(remote)
+        if mirror is None:
+            return None
+
+        with self._path_lock(mirror):
+            if os.path.isdir(mirror):
+                try:
+                    self._fetch_origin(remote, mirror, log, ['--quiet'])
+                except CalledProcessError:
+                    log.write('warning: failed to update the mirror of {}\n'.format(remote.url))
+                return mirror
+
+            try:
+                os.makedirs(self.mirror_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            # Clone next to the final location and rename, so that an
+            # interrupted clone never leaves a broken mirror behind.
+            tmp = tempfile.mkdtemp(dir=self.mirror_dir, prefix='.tmp-')
+            try:
+                log.check_call(['git', 'clone', '--mirror', '--quiet', remote.url, tmp])
+
+                # Crate clones reference objects in the mirror; they must
+                # never be garbage-collected from under them.
+                log.check_call(['git', 'config', 'gc.auto', '0'], cwd=tmp)
+                log.check_call(['git', 'config', 'gc.pruneExpire', 'never'], cwd=tmp)
+                os.rename(tmp, mirror)
+                self._fetched_now(remote, mirror)
+            except:
+                _rmtree(tmp)
+                if not os.path.isdir(mirror):
+                    raise
+
+        return mirror
+
+    def clone(self, remote, path, log, ver=None, branches=()):
+        # Nothing is checked out. Only `ver` is guaranteed to be present, and
+        # only `branches` (or the default branch) are fetched, never tags.
+        mode = remote.clone or self.clone_mode or 'full'
+        mirror = self.update_mirror(remote, log)
+
+        if mode == 'shallow' and ver is not None and mirror is None:
+            log.check_call(['git', 'init', '--quiet', path])
+            try:
+                cmd = ['git', 'remote', 'add', '--no-tags']
+                for branch in sorted(branches):
+                    cmd.extend(['-t', branch])
+                log.check_call(cmd + ['origin', remote.url], cwd=path)
+                if not branches:
+                    # Branches are tracked once some spec asks for them.
+                    log.check_call(['git', 'config', '--unset-all', 'remote.origin.fetch'], cwd=path)
+                self._fetch_commit(path, ver, log, depth=1)
+            except:
+                _rmtree(path)
+                raise
+        else:
+            branches = sorted(branches)
+
+            cmd = ['git', 'clone', '--no-checkout', '--no-tags', '--single-branch']
+            if branches:
+                cmd.extend(['--branch', branches[0]])
+            if mirror is not None:
+                cmd.extend(['--reference', mirror])
+            elif mode == 'partial':
+                cmd.append('--filter=blob:none')
+
+            log.check_call(cmd + [remote.url, path])
+            self._fetched_now(remote, path)
+
+            if len(branches) > 1:
+                self._add_branches(path, branches[1:], log)
+
+            # The locked commit needn't be on the default branch.
+            if ver is not None and not self._has_commit(path, ver, log):
+                self._fetch_commit(path, ver, log)
+
+        self._invalidate_graph(path)
+
+    def _has_commit(self, path, ver, log):
+        return self._backend(path).has_commit(ver.hash, log)
+
+    def _fetch_commit(self, path, ver, log, depth=None):
+        # Not every server lets clients fetch arbitrary commits;
+        # fall back to fetching every branch in full.
+        cmd = ['git', 'fetch', '--no-tags']
+        if depth is not None:
+            cmd.append('--depth={}'.format(depth))
+        if log.call(cmd + ['origin', ver.hash], cwd=path) != 0:
+            cmd = ['git', 'fetch', '--no-tags']
+            if self._is_shallow(path):
+                cmd.append('--unshallow')
+            log.check_call(cmd + ['origin', '+refs/heads/*:refs/remotes/origin/*'], cwd=path)
+        self._invalidate_graph(path)
+
+    def _add_branches(self, path, branches, log):
+        # Only track branches that could be fetched; a remote tracking
+        # a missing branch would fail every later fetch.
+        log.check_call(['git', 'fetch', '--no-tags', 'origin'] + ['+refs/heads/{0}:refs/remotes/origin/{0}'.format(b) for b in branches], cwd=path)
+        self._invalidate_graph(path)
+        for branch in branches:
+            log.check_call(['git', 'remote', 'set-branches', '--add', 'origin', branch], cwd=path)
+
+    def _track_branches(self, path, branches, log):
+        # Returns the tips of the sorted `branches`. A new spec may ask
+        # for branches the crate doesn't fetch yet, and history queries
+        # need the whole history.
+        branches = sorted(branches)
+        if self._is_shallow(path):
+            key = os.path.abspath(path), tuple(branches)
+            with self._graphs_lock:
+                deepen = key not in self._deepened
+                self._deepened.add(key)
+            if deepen:
+                self._deepen(path, branches, log)
+
+        missing = [b for b in branches if self._tip(path, b, log) is None]
+        if missing:
+            self._add_branches(path, missing, log)
+        return [self._tip(path, b, log) for b in branches]
+
+    def _is_shallow(self, path):
+        return os.path.isfile(os.path.join(path, '.git', 'shallow'))
+
+    def _deepen(self, path, branches, log):
+        # Only the history of the branches asked for.
+        refspecs = ['+refs/heads/{0}:refs/remotes/origin/{0}'.format(b) for b in sorted(branches)]
+        log.check_call(['git', 'fetch', '--no-tags', '--unshallow', 'origin'] + refspecs, cwd=path)
+        self._invalidate_graph(path)
+
+    def _fetch_key(self, remote, path):
+        return '{}\0{}'.format(remote.url, os.path.realpath(path))
+
+    def _fetched_now(self, remote, path):
+        key = self._fetch_key(remote, path)
+        with self._fetched_lock:
+            self._fetched.add(key)
+
+        if self.fetch_window > 0:
+            from .cache import fetch_times_cache
+            cache = fetch_times_cache()
+            if cache is not None:
+                cache.put(key, time.time())
+
+    def _is_fresh(self, key):
+        with self._fetched_lock:
+            if key in self._fetched:
+                return True
+
+        if self.fetch_window <= 0:
+            return False
+
+        from .cache import fetch_times_cache
+        cache = fetch_times_cache()
+        t = cache.get(key) if cache is not None else None
+        return t is not None and 0 <= time.time() - t < self.fetch_window
+
+    def _fetch_origin(self, remote, path, log, args=()):
+        # Skipped if the repository was fetched within the window; concurrent
+        # callers wait for the first fetch. Returns True if git was run.
+        key = self._fetch_key(remote, path)
+        with self._path_lock(key):
+            shallow = self._is_shallow(path)
+            if not shallow and self._is_fresh(key):
+                return False
+
+            # Only the tracked branches; crater never uses tags.
+            cmd = ['git', 'fetch', '--no-tags'] + list(args)
+            if shallow:
+                cmd.append('--unshallow')
+            log.check_call(cmd + ['origin'], cwd=path)
+            self._fetched_now(remote, path)
+
+        self._invalidate_graph(path)
+        return True
 
     def save_lock(self, remote, ver):
-        return {
+        r = {
             'type': 'git',
             'url': remote.url,
             'commit': ver.hash,
             }
+        if remote.clone is not None:
+            r['clone'] = remote.clone
+        return r
+
+    def cache_key(self, remote, ver):
+        return 'git\0{}\0{}'.format(remote.url, ver.hash)
+
+    # The number of commits read by the first `git log` call in `versions`;
+    # each further page is twice as large as the previous one.
+    versions_page_size = 32
 
     def versions(self, path, dep_spec, log):
-        if len(dep_spec._branches) == 1:
-            merge_base = log.check_output(['git', 'rev-parse', '--quiet', '--verify', 'origin/{}'.format(next(iter(dep_spec._branches)))], cwd=path).decode().strip()
-        else:
-            merge_base = log.check_output(['git', 'merge-base'] + ['origin/{}'.format(b) for b in dep_spec._branches], cwd=path).decode().strip()
+        merge_base = self._merge_base(path, dep_spec._branches, log)
+        return self._iter_history(path, merge_base, log)
 
-        commits = log.check_output(['git', 'log', '--pretty=format:%H', merge_base], cwd=path).decode().strip().split()
-        return [GitVersion(hash) for hash in commits]
+    def _iter_history(self, path, rev, log):
+        for hash in self._backend(path).history(rev, log, self.versions_page_size):
+            yield GitVersion(hash)
 
     def get_deps_file(self, path, ver, log):
-        root_tree = log.check_output(['git', 'ls-tree', '--name-only', ver.hash], cwd=path).decode().split()
-        if 'DEPS' in root_tree:
-            return log.check_output(['git', 'show', '{}:DEPS'.format(ver.hash)], cwd=path).decode()
-        else:
-            return '{}'
+        backend = self._backend(path)
+
+        obj = backend.read('{}:DEPS'.format(ver.hash))
+        if obj is not None and obj[0] == 'blob':
+            return obj[1].decode()
+
+        if backend.read('{}^{{commit}}'.format(ver.hash)) is None:
+            raise RuntimeError('unknown commit {} in {}'.format(ver.hash, path))
+        return '{}'
+
+    def is_checked_out(self, path, ver):
+        # Crates are always left on a detached HEAD. A clone made with
+        # --no-checkout has a HEAD, but no index yet.
+        git_dir = os.path.join(path, '.git')
+        try:
+            with open(os.path.join(git_dir, 'HEAD'), 'rb') as fin:
+                head = fin.read().strip()
+        except IOError:
+            return False
+        return head.decode() == ver.hash and os.path.isfile(os.path.join(git_dir, 'index'))
 
     def checkout(self, remote, ver, path, log):
+        if self.is_checked_out(path, ver):
+            return
+
         log.write('Checking out {}...\n'.format(path))
 
-        if os.path.isdir(os.path.join(path, '.git')):
-            r = log.call(['git', 'rev-parse', '--quiet', '--verify', '{}^{{commit}}'.format(ver.hash)], stdout=None, cwd=path)
-            if r != 0:
-                log.check_call(['git', 'fetch', 'origin'], cwd=path)
+        # Crates checked out in place are left alone, they may have changes.
+        if self.store_dir and (os.path.islink(path) or not os.path.exists(path)):
+            self._copy_from_store(remote, ver, path, log)
+            return
 
-            #commit = subprocess.check_output(['git', 'rev-parse', '--verify', 'HEAD'], cwd=path).strip()
-            #if commit == self._commit:
-            #    return
+        if os.path.isdir(os.path.join(path, '.git')):
+            if not self._has_commit(path, ver, log):
+                self._fetch_commit(path, ver, log, depth=1 if self._is_shallow(path) else None)
         else:
             try:
                 os.makedirs(os.path.split(path)[0])
@@ -79,32 +698,176 @@ class GitHandler:
                 if e.errno != errno.EEXIST:
                     raise
 
-            log.check_call(['git', 'clone', remote.url, path, '--no-checkout'])
+            self.clone(remote, path, log, ver)
 
         # XXX print('checkout {} to {}'.format(lock.commit, lock.path))
         log.check_call(['git', 'config', 'hooks.suppresscrater', 'true'], cwd=path)
         log.check_call(['git', '-c', 'advice.detachedHead=false', 'checkout', ver.hash], cwd=path)
 
-    def fetch(self, path, log):
-        log.check_call(['git', 'fetch', 'origin'], cwd=path)
+    def _copy_from_store(self, remote, ver, path, log):
+        # The crate gets a repository of its own that borrows the entry's
+        # objects, and a working tree of hard links to the entry's
+        # read-only files. Fetches and generated files stay in the project.
+        entry = self.store_path(remote, ver)
+        self._make_store_entry(remote, ver, entry, log)
 
-    def current_version(self, path, log):
+        parent, name = os.path.split(os.path.abspath(path))
         try:
-            commit = log.check_output(['git', 'rev-parse', '--quiet', '--verify', 'HEAD'], cwd=path).decode().strip()
-        except log.CalledProcessError as e:
-            return None
+            os.makedirs(parent)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        tmp = tempfile.mkdtemp(dir=parent, prefix='.{}.tmp-'.format(name))
+        try:
+            set_default_mode(tmp, is_dir=True)
+
+            entry_git_dir = os.path.join(entry, '.git')
+            git_dir = os.path.join(tmp, '.git')
+            shutil.copytree(entry_git_dir, git_dir, ignore=lambda dir, names: ['objects'] if dir == entry_git_dir else [])
+            os.makedirs(os.path.join(git_dir, 'objects', 'info'))
+            os.mkdir(os.path.join(git_dir, 'objects', 'pack'))
+            with open(os.path.join(git_dir, 'objects', 'info', 'alternates'), 'w') as fout:
+                fout.write('{}\n'.format(os.path.join(entry_git_dir, 'objects')))
+
+            _link_tree(entry, tmp)
+
+            # The links changed the files' ctime, which the copied index records.
+            log.check_call(['git', 'update-index', '-q', '--refresh'], cwd=tmp)
+
+            # Crates used to be symlinks to their store entry.
+            if os.path.islink(path):
+                os.remove(path)
+            os.rename(tmp, path)
+        except:
+            _rmtree(tmp)
+            raise
+
+        self._invalidate_graph(path)
+
+    def _make_store_entry(self, remote, ver, entry, log):
+        with self._path_lock(entry):
+            if self.is_checked_out(entry, ver):
+                return
+
+            parent = os.path.dirname(entry)
+            if os.path.isdir(entry):
+                _rmtree(entry)
+            elif not os.path.isdir(parent):
+                os.makedirs(parent)
+
+            tmp = tempfile.mkdtemp(dir=parent, prefix='.tmp-')
+            try:
+                set_default_mode(tmp, is_dir=True)
+                self.clone(remote, tmp, log, ver)
+                log.check_call(['git', 'config', 'hooks.suppresscrater', 'true'], cwd=tmp)
+                log.check_call(['git', '-c', 'advice.detachedHead=false', 'checkout', ver.hash], cwd=tmp)
+                _make_read_only(tmp)
+                os.rename(tmp, entry)
+            except:
+                if os.path.isdir(tmp):
+                    _rmtree(tmp)
+                if not self.is_checked_out(entry, ver):
+                    raise
+
+    def fetch(self, remote, path, dep_spec, log):
+        self._fetch_origin(remote, path, log)
+
+    def prefetch(self, remote, path, ver, dep_spec, log):
+        # Never touches the working tree. Returns the DEPS files of `ver`
+        # and of the spec's branch tips, as far as they are available.
+        mirror = self.update_mirror(remote, log)
+        branches = sorted(dep_spec._branches) if dep_spec is not None else []
+
+        repo = None
+        if path is not None and not os.path.islink(path):
+            if os.path.isdir(os.path.join(path, '.git')):
+                self._fetch_origin(remote, path, log)
+                if ver is not None and not self._has_commit(path, ver, log):
+                    self._fetch_commit(path, ver, log, depth=1 if self._is_shallow(path) else None)
+            elif ver is not None and not os.path.exists(path) and not self.store_dir:
+                # `crater checkout` will find the clone and only
+                # fill in the working tree.
+                self.clone(remote, path, log, ver, branches)
+
+            if os.path.isdir(os.path.join(path, '.git')):
+                if branches:
+                    self._track_branches(path, branches, log)
+                repo, tips = path, ['origin/{}'.format(b) for b in branches]
+
+        if repo is None:
+            if mirror is None:
+                return []
+            repo, tips = mirror, branches
+
+        revs = ([ver.hash] if ver is not None else []) + tips
+        backend = self._backend(repo)
+
+        r = []
+        for rev in revs:
+            obj = backend.read('{}:DEPS'.format(rev))
+            if obj is not None and obj[0] == 'blob':
+                r.append(obj[1].decode())
+        return r
+
+    def current_version(self, path, log):
+        commit = read_head(os.path.join(path, '.git'))
+        if commit is None:
+            try:
+                commit = log.check_output(['git', 'rev-parse', '--quiet', '--verify', 'HEAD'], cwd=path).decode().strip()
+            except CalledProcessError as e:
+                return None
 
         return GitVersion(commit)
 
+    # File timestamps may be truncated to whole seconds (or two seconds
+    # on FAT); anything this close to the last check is considered modified.
+    _timestamp_slack = 2
+
+    def _status_signature(self, git_dir):
+        return {
+            'head': read_head(git_dir),
+            'HEAD': _stat_key(os.path.join(git_dir, 'HEAD')),
+            'index': _stat_key(os.path.join(git_dir, 'index')),
+            }
+
     def is_dirty(self, path, log):
+        # Remember the result along with the state of HEAD and the index.
+        # If neither changed and nothing in the working tree was touched
+        # since, the answer is still the same and git need not run.
+        git_dir = os.path.join(path, '.git')
+        state_path = os.path.join(git_dir, 'crater-status')
+
+        try:
+            with open(state_path, 'r') as fin:
+                state = json.load(fin)
+        except (IOError, ValueError):
+            state = None
+
+        if (state is not None and state.get('sig') == self._status_signature(git_dir) and 'files' in state
+                and not _files_changed_since(path, state['files'], state['time'] - self._timestamp_slack)):
+            return state['dirty']
+
+        start = time.time()
         try:
             log.check_call(['git', 'update-index', '-q', '--refresh'], cwd=path)
-            return log.call(['git', 'diff-index', '--quiet', 'HEAD', '--'], cwd=path) != 0
-        except log.CalledProcessError as e:
+            dirty = log.call(['git', 'diff-index', '--quiet', 'HEAD', '--'], cwd=path) != 0
+            files = log.check_output(['git', 'ls-files', '-z'], cwd=path)
+        except CalledProcessError as e:
             return True
 
+        # The tracked files only change along with the index.
+        files = [name.decode('utf-8', 'replace') for name in files.split(b'\0') if name]
+        try:
+            with open(state_path, 'w') as fout:
+                json.dump({ 'sig': self._status_signature(git_dir), 'time': start, 'dirty': dirty, 'files': files }, fout)
+        except IOError:
+            pass
+
+        return dirty
+
     def load_lock(self, spec):
-        return GitRemote(spec['url']), GitVersion(spec['commit'])
+        return GitRemote(spec['url'], spec.get('clone')), GitVersion(spec['commit'])
 
     def load_depspec(self, spec):
         url = spec.get('repo') or spec['url']
@@ -112,13 +875,23 @@ class GitHandler:
         if isinstance(branches, six.string_types):
             branches = [branches]
 
-        return GitRemote(url), GitDepSpec(branches)
+        return GitRemote(url, spec.get('clone')), GitDepSpec(branches)
 
     def empty_dep_spec(self):
         return GitDepSpec(())
 
     def is_compatible_ver(self, path, log, ver, ds):
-        return log.check_output(['git', 'merge-base', ver.hash] + list(ds._branches), cwd=path).decode().strip() == ver.hash
+        # The version must be reachable from every one of the branches.
+        # A graph is only worth loading when `_merge_base` needed one anyway.
+        tips = self._track_branches(path, ds._branches, log)
+        graph = self._graph(path, tips, log) if len(tips) > 1 and all(tips) else None
+        for branch, tip in zip(sorted(ds._branches), tips):
+            r = graph.is_ancestor(ver.hash, tip) if graph is not None else None
+            if r is None:
+                r = log.call(['git', 'merge-base', '--is-ancestor', ver.hash, 'origin/{}'.format(branch)], cwd=path) == 0
+            if not r:
+                return False
+        return True
 
 class GitDepSpec:
     def __init__(self, branches):
@@ -127,24 +900,13 @@ class GitDepSpec:
     def init(self, path, remote, log):
         assert self._branches
 
-        log.check_call(['git', 'clone', remote.url, path, '--no-checkout'])
-
         try:
-            log.check_call(['git', 'fetch', 'origin'] + list(self._branches), cwd=path)
-
-            if len(self._branches) == 1:
-                merge_base = log.check_output(['git', 'rev-parse', '--quiet', '--verify', 'origin/{}'.format(next(iter(self._branches)))], cwd=path).decode().strip()
-            else:
-                merge_base = log.check_output(['git', 'merge-base'] + ['origin/{}'.format(b) for b in self._branches], cwd=path).decode().strip()
-
+            git_handler.clone(remote, path, log, branches=self._branches)
+            merge_base = git_handler._merge_base(path, self._branches, log)
             return git_handler, GitVersion(merge_base)
         except:
-            def readonly_handler(rm_func, path, exc_info):
-                if issubclass(exc_info[0], OSError) and exc_info[1].winerror == 5:
-                    os.chmod(path, stat.S_IWRITE)
-                    return rm_func(path)
-                raise exc_info[1]
-            shutil.rmtree(path, onerror=readonly_handler)
+            if os.path.exists(path):
+                _rmtree(path)
             raise
 
     def join(self, o):
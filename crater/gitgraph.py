@@ -0,0 +1,175 @@
+import binascii, heapq
+from array import array
+
+# An in-memory commit DAG answering ancestry and merge-base queries.
+# Generation numbers let walks stop early. Queries about unknown commits
+# return None; the caller asks git instead.
+class CommitGraph:
+    def __init__(self, refs, commits):
+        # `commits` lists each commit's hash followed by its parents',
+        # like `git rev-list --parents`.
+        self._ids = {}
+        self._parents = []
+        self._hashes = None
+
+        commits = [toks for toks in commits if toks]
+        for toks in commits:
+            self._id(toks[0])
+
+        for toks in commits:
+            idx = self._ids[binascii.unhexlify(toks[0])]
+            self._parents[idx] = tuple(self._id(tok) for tok in toks[1:])
+
+        self._gen = self._compute_generations()
+        self._refs = dict(refs)
+
+    @classmethod
+    def load(cls, path, log, tips=None):
+        # Given `tips`, only their history is loaded, and no refs.
+        if tips is not None:
+            rev_list = log.check_output(['git', 'rev-list', '--parents'] + list(tips), cwd=path)
+            return cls({}, (line.split() for line in rev_list.split(b'\n')))
+
+        out = log.check_output(['git', 'for-each-ref', '--format=%(objectname) %(*objectname) %(refname)'], cwd=path)
+        refs = {}
+        for line in out.split(b'\n'):
+            toks = line.split()
+            if len(toks) == 3:
+                obj, peeled, name = toks
+                obj = peeled
+            elif len(toks) == 2:
+                obj, name = toks
+            else:
+                continue
+            refs[name.decode('utf-8')] = obj.decode()
+
+        rev_list = log.check_output(['git', 'rev-list', '--parents', '--all'], cwd=path)
+        return cls(refs, (line.split() for line in rev_list.split(b'\n')))
+
+    def _id(self, hash):
+        key = binascii.unhexlify(hash)
+        r = self._ids.get(key)
+        if r is None:
+            r = len(self._parents)
+            self._ids[key] = r
+            self._parents.append(())
+        return r
+
+    def _compute_generations(self):
+        # rev-list lists children before their parents,
+        # so going backwards mostly finds the parents already done.
+        gen = array('l', [0]) * len(self._parents)
+        for start in reversed(range(len(self._parents))):
+            if gen[start]:
+                continue
+
+            stack = [start]
+            while stack:
+                idx = stack[-1]
+                if gen[idx]:
+                    stack.pop()
+                    continue
+
+                pending = [p for p in self._parents[idx] if not gen[p]]
+                if pending:
+                    stack.extend(pending)
+                    continue
+
+                stack.pop()
+                gen[idx] = 1 + max([gen[p] for p in self._parents[idx]] or [0])
+        return gen
+
+    def _lookup(self, hash):
+        try:
+            return self._ids.get(binascii.unhexlify(hash))
+        except (TypeError, ValueError, binascii.Error):
+            return None
+
+    def resolve(self, name):
+        # Follows git's lookup rules for ref names.
+        for templ in ('{}', 'refs/{}', 'refs/tags/{}', 'refs/heads/{}', 'refs/remotes/{}', 'refs/remotes/{}/HEAD'):
+            r = self._refs.get(templ.format(name))
+            if r is not None:
+                return r
+        return None
+
+    def is_ancestor(self, ancestor, descendant):
+        a = self._lookup(ancestor)
+        d = self._lookup(descendant)
+        if a is None or d is None:
+            return None
+
+        if a == d:
+            return True
+
+        gen = self._gen
+        limit = gen[a]
+
+        seen = set([d])
+        stack = [d]
+        while stack:
+            idx = stack.pop()
+            for p in self._parents[idx]:
+                if p == a:
+                    return True
+                if p not in seen and gen[p] > limit:
+                    seen.add(p)
+                    stack.append(p)
+
+        return False
+
+    def merge_bases(self, commits):
+        # The common ancestors that aren't ancestors of another one.
+        ids = [self._lookup(c) for c in commits]
+        if not ids or any(idx is None for idx in ids):
+            return None
+
+        gen = self._gen
+        all_flags = (1 << len(ids)) - 1
+        stale = 1 << len(ids)
+
+        flags = {}
+        queue = []
+        for i, idx in enumerate(ids):
+            if idx not in flags:
+                heapq.heappush(queue, (-gen[idx], idx))
+            flags[idx] = flags.get(idx, 0) | (1 << i)
+
+        # Walk down the generations, painting each commit with the set of
+        # tips it's reachable from. Commits painted by every tip are common
+        # ancestors; everything below them is stale and can't be a best one.
+        results = []
+        active = len(queue)
+        while active:
+            _, idx = heapq.heappop(queue)
+            f = flags[idx]
+            if not f & stale:
+                active -= 1
+
+            if f & all_flags == all_flags and not f & stale:
+                results.append(idx)
+                f |= stale
+
+            for p in self._parents[idx]:
+                pf = flags.get(p)
+                nf = (pf or 0) | f
+                if pf is None:
+                    heapq.heappush(queue, (-gen[p], p))
+                    if not nf & stale:
+                        active += 1
+                elif not pf & stale and nf & stale:
+                    # Parents always come after their children, so `p`
+                    # is still waiting in the queue.
+                    active -= 1
+                flags[p] = nf
+
+        # The walk may have found common ancestors of other results.
+        results = [self._hash(idx) for idx in results]
+        return [c for c in results if not any(o != c and self.is_ancestor(c, o) for o in results)]
+
+    def _hash(self, idx):
+        if self._hashes is None:
+            self._hashes = [None] * len(self._parents)
+            for key, i in self._ids.items():
+                self._hashes[i] = binascii.hexlify(key).decode()
+        return self._hashes[idx]
@@ -0,0 +1,567 @@
+# Reads git objects and refs from the repository files. Whatever isn't
+# supported or is corrupt raises one of `read_errors`; the caller asks git.
+
+import os, re, zlib, struct, binascii, heapq, threading, collections, six
+
+_types = { 1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag' }
+_ofs_delta = 6
+_ref_delta = 7
+
+# Git itself refuses deeper chains; corrupt packs could loop forever.
+_max_delta_chain = 10000
+
+# Bytes of inflated objects each pack keeps for resolving delta chains.
+_delta_cache_size = 16 * 1024 * 1024
+
+# Revisions looked up like `git rev-parse` does for a bare name.
+_ref_templates = ('{}', 'refs/{}', 'refs/tags/{}', 'refs/heads/{}', 'refs/remotes/{}', 'refs/remotes/{}/HEAD')
+
+_hex_re = re.compile(r'^[0-9a-f]{40}$')
+_parent_re = re.compile(br'^parent ([0-9a-f]{40})$', re.M)
+_committer_re = re.compile(br'^committer .* (\d+) [-+]\d{4}$', re.M)
+
+class UnsupportedRepository(Exception):
+    pass
+
+class MissingObject(Exception):
+    pass
+
+# RuntimeError also covers RecursionError; IndexError, truncated headers.
+read_errors = (UnsupportedRepository, MissingObject, ValueError, IndexError, RuntimeError, zlib.error, struct.error)
+
+def find_git_dir(path):
+    # Also follows the .git files of linked worktrees and submodules.
+    dot_git = os.path.join(path, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+
+    if os.path.isfile(dot_git):
+        # Linked worktrees and submodules point to their git directory.
+        with open(dot_git, 'r') as fin:
+            line = fin.readline().strip()
+        if line.startswith('gitdir:'):
+            return os.path.join(path, line[7:].strip())
+        return None
+
+    if os.path.isfile(os.path.join(path, 'HEAD')) and os.path.isdir(os.path.join(path, 'objects')):
+        return path
+    return None
+
+def _varint(data, i):
+    # The size encoding of delta headers, least significant group first.
+    r = 0
+    shift = 0
+    while True:
+        c = data[i]
+        i += 1
+        r |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return i, r
+
+def _apply_delta(base, delta):
+    d = bytearray(delta)
+    i, src_size = _varint(d, 0)
+    i, dst_size = _varint(d, i)
+    if src_size != len(base):
+        raise ValueError('the delta base has a wrong size')
+
+    out = []
+    while i < len(d):
+        c = d[i]
+        i += 1
+        if c & 0x80:
+            offset = size = 0
+            for k in range(4):
+                if c & (1 << k):
+                    offset |= d[i] << (8 * k)
+                    i += 1
+            for k in range(3):
+                if c & (0x10 << k):
+                    size |= d[i] << (8 * k)
+                    i += 1
+            out.append(base[offset:offset + (size or 0x10000)])
+        elif c:
+            out.append(bytes(d[i:i + c]))
+            i += c
+        else:
+            raise ValueError('invalid delta instruction')
+
+    r = b''.join(out)
+    if len(r) != dst_size:
+        raise ValueError('the delta produced an object of a wrong size')
+    return r
+
+class _Pack:
+    def __init__(self, path):
+        with open(path + '.idx', 'rb') as fin:
+            idx = fin.read()
+
+        if idx[:4] != b'\xfftOc' or struct.unpack('>I', idx[4:8])[0] != 2:
+            raise UnsupportedRepository('unsupported pack index: {}.idx'.format(path))
+
+        self._fanout = struct.unpack('>256I', idx[8:8 + 1024])
+        n = self._fanout[255]
+
+        start = 8 + 1024
+        self._names = idx[start:start + 20 * n]
+        start += 24 * n
+        self._offsets = idx[start:start + 4 * n]
+        self._large_offsets = idx[start + 4 * n:]
+
+        self._file = open(path + '.pack', 'rb')
+        self._cache = collections.OrderedDict()
+        self._cache_bytes = 0
+
+    def close(self):
+        self._file.close()
+
+    def find(self, name):
+        first = six.indexbytes(name, 0)
+        lo = self._fanout[first - 1] if first else 0
+        hi = self._fanout[first]
+        names = self._names
+        while lo < hi:
+            mid = (lo + hi) // 2
+            r = names[20 * mid:20 * mid + 20]
+            if r < name:
+                lo = mid + 1
+            elif r > name:
+                hi = mid
+            else:
+                offset = struct.unpack('>I', self._offsets[4 * mid:4 * mid + 4])[0]
+                if offset & 0x80000000:
+                    idx = offset & 0x7fffffff
+                    offset = struct.unpack('>Q', self._large_offsets[8 * idx:8 * idx + 8])[0]
+                return offset
+        return None
+
+    def read(self, offset, store):
+        # Delta chains are followed down to a cached or whole base,
+        # then their deltas are applied on the way back up.
+        deltas = []
+        while True:
+            r = self._cache_get(offset)
+            if r is not None:
+                break
+            if len(deltas) > _max_delta_chain:
+                raise ValueError('delta chain too long in a pack')
+
+            type, size, i = self._header(offset)
+            if type in _types:
+                r = _types[type], self._inflate(offset + i, size)
+                self._cache_put(offset, r)
+                break
+
+            if type == _ofs_delta:
+                header = self._header_bytes
+                c = header[i]
+                i += 1
+                distance = c & 0x7f
+                while c & 0x80:
+                    c = header[i]
+                    i += 1
+                    distance = ((distance + 1) << 7) | (c & 0x7f)
+                if not 0 < distance <= offset:
+                    raise ValueError('invalid delta base offset in a pack')
+                deltas.append((offset, self._inflate(offset + i, size)))
+                offset -= distance
+            elif type == _ref_delta:
+                name = bytes(self._header_bytes[i:i + 20])
+                deltas.append((offset, self._inflate(offset + i + 20, size)))
+                offset = self.find(name)
+                if offset is None:
+                    # Thin packs aren't kept, but the base may be loose.
+                    r = store._read(name)
+                    break
+            else:
+                raise ValueError('unknown object type {} in a pack'.format(type))
+
+        base_type, base = r
+        for offset, delta in reversed(deltas):
+            base = _apply_delta(base, delta)
+            self._cache_put(offset, (base_type, base))
+        return base_type, base
+
+    def _header(self, offset):
+        self._file.seek(offset)
+        header = self._header_bytes = bytearray(self._file.read(32))
+
+        c = header[0]
+        type = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        i = 1
+        while c & 0x80:
+            c = header[i]
+            i += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, i
+
+    def _cache_get(self, offset):
+        r = self._cache.pop(offset, None)
+        if r is not None:
+            self._cache[offset] = r
+        return r
+
+    def _cache_put(self, offset, obj):
+        # Objects in delta chains are bases of many others; keep the
+        # most recently used ones inflated, like git's delta base cache.
+        size = len(obj[1])
+        if size > _delta_cache_size // 4:
+            return
+        old = self._cache.pop(offset, None)
+        if old is not None:
+            self._cache_bytes -= len(old[1])
+        self._cache[offset] = obj
+        self._cache_bytes += size
+        while self._cache_bytes > _delta_cache_size:
+            _, old = self._cache.popitem(last=False)
+            self._cache_bytes -= len(old[1])
+
+    def _inflate(self, pos, size):
+        self._file.seek(pos)
+        d = zlib.decompressobj()
+        out = []
+        got = 0
+        while got < size or not out:
+            chunk = self._file.read(max(4096, size - got))
+            if not chunk:
+                raise ValueError('truncated pack')
+            data = d.decompress(chunk)
+            out.append(data)
+            got += len(data)
+        return b''.join(out)
+
+# Packs are looked for again whenever an object isn't found;
+# refs are read anew on every call.
+class ObjectStore:
+    def __init__(self, git_dir):
+        self._git_dir = git_dir
+
+        try:
+            with open(os.path.join(git_dir, 'config'), 'r') as fin:
+                config = fin.read().lower()
+        except IOError:
+            config = ''
+        if re.search(r'objectformat\s*=\s*(?!sha1\b)', config) or os.path.isdir(os.path.join(git_dir, 'reftable')):
+            raise UnsupportedRepository('{} needs git to be read'.format(git_dir))
+
+        self._object_dirs = []
+        self._add_object_dir(os.path.join(git_dir, 'objects'))
+
+        try:
+            with open(os.path.join(git_dir, 'shallow'), 'r') as fin:
+                self._shallow = set(line.strip() for line in fin)
+        except IOError:
+            self._shallow = set()
+
+        self._packs = None
+        self._lock = threading.Lock()
+        self._commits = {}
+
+    @classmethod
+    def open(cls, path):
+        git_dir = find_git_dir(path)
+        if git_dir is None:
+            raise UnsupportedRepository('{} is not a git repository'.format(path))
+        return cls(git_dir)
+
+    def _add_object_dir(self, dir):
+        dir = os.path.normpath(dir)
+        if dir in self._object_dirs:
+            return
+        self._object_dirs.append(dir)
+
+        # Clones made with --reference borrow objects from elsewhere.
+        try:
+            with open(os.path.join(dir, 'info', 'alternates'), 'r') as fin:
+                alternates = [line.strip() for line in fin]
+        except IOError:
+            return
+
+        for alt in alternates:
+            if alt and not alt.startswith('#'):
+                self._add_object_dir(os.path.join(dir, alt))
+
+    def close(self):
+        with self._lock:
+            self._close_packs()
+
+    def _close_packs(self):
+        for pack in six.itervalues(self._packs or {}):
+            pack.close()
+        self._packs = None
+
+    def _load_packs(self):
+        # Packs are never modified, only added and removed,
+        # so the ones already open are kept.
+        old = self._packs or {}
+        packs = {}
+        for dir in self._object_dirs:
+            pack_dir = os.path.join(dir, 'pack')
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except OSError:
+                continue
+            for name in names:
+                base = os.path.join(pack_dir, name[:-4])
+                if name.endswith('.idx') and os.path.isfile(base + '.pack'):
+                    packs[base] = old.pop(base, None) or _Pack(base)
+
+        for pack in six.itervalues(old):
+            pack.close()
+        self._packs = packs
+
+    def _read_loose(self, name):
+        hex = binascii.hexlify(name).decode()
+        for dir in self._object_dirs:
+            try:
+                with open(os.path.join(dir, hex[:2], hex[2:]), 'rb') as fin:
+                    data = zlib.decompress(fin.read())
+            except IOError:
+                continue
+
+            header, _, content = data.partition(b'\0')
+            return header.split(b' ')[0].decode(), content
+        return None
+
+    def _read_packed(self, name):
+        for pack in six.itervalues(self._packs):
+            offset = pack.find(name)
+            if offset is not None:
+                return pack.read(offset, self)
+        return None
+
+    def _read(self, name):
+        # Called with the lock held.
+        if self._packs is None:
+            self._load_packs()
+
+        r = self._read_packed(name)
+        if r is None:
+            r = self._read_loose(name)
+        if r is None:
+            # A fetch or a repack may have added packs since.
+            self._load_packs()
+            r = self._read_packed(name)
+        if r is None:
+            raise MissingObject(binascii.hexlify(name).decode())
+        return r
+
+    def read(self, hex):
+        # Raises MissingObject if the object isn't on the disk.
+        with self._lock:
+            return self._read(binascii.unhexlify(hex))
+
+    def _read_ref_file(self, name):
+        try:
+            with open(os.path.join(self._git_dir, name), 'r') as fin:
+                return fin.read().strip()
+        except IOError:
+            return None
+
+    def refs(self):
+        return self._read_refs()[0]
+
+    def _read_refs(self):
+        # Also returns what packed-refs says annotated tags peel to.
+        r = {}
+        peeled = {}
+        try:
+            with open(os.path.join(self._git_dir, 'packed-refs'), 'r') as fin:
+                last = None
+                for line in fin:
+                    line = line.strip()
+                    if not line or line.startswith('#'):
+                        continue
+                    if line.startswith('^'):
+                        peeled[last] = line[1:]
+                        continue
+                    obj, _, last = line.partition(' ')
+                    r[last] = obj
+        except IOError:
+            pass
+
+        symbolic = {}
+        refs_dir = os.path.join(self._git_dir, 'refs')
+        for dir, dirs, files in os.walk(refs_dir):
+            for fname in files:
+                name = os.path.relpath(os.path.join(dir, fname), self._git_dir).replace(os.sep, '/')
+                value = self._read_ref_file(name)
+                if value is None:
+                    continue
+                if value.startswith('ref: '):
+                    symbolic[name] = value[5:].strip()
+                elif _hex_re.match(value):
+                    r[name] = value
+
+        for name, target in six.iteritems(symbolic):
+            if target in r:
+                r[name] = r[target]
+        return r, peeled
+
+    def head(self, refs=None):
+        value = self._read_ref_file('HEAD')
+        if value is None:
+            return None
+        if value.startswith('ref: '):
+            if refs is None:
+                refs = self.refs()
+            return refs.get(value[5:].strip())
+        return value if _hex_re.match(value) else None
+
+    def peel(self, hex):
+        while True:
+            type, content = self.read(hex)
+            if type != 'tag':
+                return type, hex
+            hex = content.split(b'\n', 1)[0].split(b' ')[1].decode()
+
+    def commit(self, hex):
+        # The parents and the committer time.
+        with self._lock:
+            r = self._commits.get(hex)
+        if r is not None:
+            return r
+
+        type, content = self.read(hex)
+        if type != 'commit':
+            raise ValueError('{} is a {}, not a commit'.format(hex, type))
+
+        # The message may be long; only the header is needed.
+        header = content.split(b'\n\n', 1)[0]
+        parents = [m.decode() for m in _parent_re.findall(header)]
+        m = _committer_re.search(header)
+        time = int(m.group(1)) if m is not None else 0
+
+        # Shallow clones cut the history at these commits.
+        if hex in self._shallow:
+            parents = []
+
+        r = tuple(parents), time
+        with self._lock:
+            self._commits[hex] = r
+        return r
+
+    def commit_graph_input(self, tips=None):
+        # The refs peeled to commits, and the commits reachable from them
+        # as `git rev-list --parents --all` lists them. Given `tips`,
+        # only the commits reachable from those, and no refs.
+        if tips is not None:
+            return {}, self._reachable(tips)
+
+        all_refs, packed_peeled = self._read_refs()
+
+        refs = {}
+        for name, hex in six.iteritems(all_refs):
+            peeled = packed_peeled.get(name)
+            if peeled is None:
+                type, peeled = self.peel(hex)
+                if type != 'commit':
+                    continue
+            refs[name] = peeled
+
+        tips = set(refs.values())
+        head = self.head(all_refs)
+        if head is not None:
+            tips.add(head)
+        return refs, self._reachable(tips)
+
+    def _reachable(self, tips):
+        commits = []
+        seen = set(tips)
+        stack = list(tips)
+        while stack:
+            hex = stack.pop()
+            parents = self.commit(hex)[0]
+            commits.append([hex.encode()] + [p.encode() for p in parents])
+            for p in parents:
+                if p not in seen:
+                    seen.add(p)
+                    stack.append(p)
+        return commits
+
+    def history(self, hex):
+        # In `git log` order: newest committer time first, ties in the order reached.
+        counter = 0
+        queue = [(-self.commit(hex)[1], counter, hex)]
+        seen = set([hex])
+        while queue:
+            _, _, hex = heapq.heappop(queue)
+            yield hex
+            for p in self.commit(hex)[0]:
+                if p not in seen:
+                    seen.add(p)
+                    counter += 1
+                    heapq.heappush(queue, (-self.commit(p)[1], counter, p))
+
+    def resolve(self, name):
+        if _hex_re.match(name):
+            return name
+
+        if name == 'HEAD':
+            return self.head()
+
+        refs = self.refs()
+        for templ in _ref_templates:
+            r = refs.get(templ.format(name))
+            if r is not None:
+                return r
+        return None
+
+    def read_rev(self, rev):
+        # Like `git cat-file --batch`; only `<rev>`, `<rev>^{commit}`
+        # and `<rev>:<path>` are understood.
+        rev, sep, path = rev.partition(':')
+        want_commit = rev.endswith('^{commit}')
+        if want_commit:
+            rev = rev[:-len('^{commit}')]
+        if not rev or any(c in rev for c in '^~@{'):
+            raise UnsupportedRepository('unsupported revision: {}'.format(rev))
+
+        hex = self.resolve(rev)
+        if hex is None:
+            return None
+
+        try:
+            type, content = self.read(hex)
+        except MissingObject:
+            if _hex_re.match(rev):
+                # Most likely not an object of this repository at all.
+                return None
+            raise
+
+        if not want_commit and not sep:
+            return type, content
+
+        while type == 'tag':
+            type, content = self.read(content.split(b'\n', 1)[0].split(b' ')[1].decode())
+        if type != 'commit':
+            return None
+        if not sep:
+            return type, content
+
+        hex = content[5:45].decode()
+        for part in path.split('/'):
+            if part:
+                hex = self._tree_entry(hex, part)
+                if hex is None:
+                    return None
+        return self.read(hex)
+
+    def _tree_entry(self, hex, name):
+        type, content = self.read(hex)
+        if type != 'tree':
+            return None
+
+        name = name.encode('utf-8')
+        i = 0
+        while i < len(content):
+            space = content.index(b' ', i)
+            nul = content.index(b'\0', space)
+            if content[space + 1:nul] == name:
+                return binascii.hexlify(content[nul + 1:nul + 21]).decode()
+            i = nul + 21
+        return None
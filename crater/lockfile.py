@@ -1,11 +1,29 @@
-import os, json, errno, six, cson, random, string
+import os, json, errno, six, importlib
 from .selfcrate import self_handler
-from .gitcrate import git_handler
+from .cache import deps_cache
+from .gen import write_if_changed
+from . import trace
 
+# Handlers are imported when a crate of their type is first seen,
+# so that commands don't pay for crate types the project doesn't use.
 _crate_types = {
-    'git': git_handler,
+    'git': ('.gitcrate', 'git_handler'),
+    'archive': ('.archivecrate', 'archive_handler'),
     }
 
+_handlers = {}
+
+def get_handler(type):
+    r = _handlers.get(type)
+    if r is None:
+        entry = _crate_types.get(type)
+        if entry is None:
+            raise RuntimeError('unknown dependency type: {}'.format(type))
+        module, name = entry
+        r = getattr(importlib.import_module(module, __package__), name)
+        _handlers[type] = r
+    return r
+
 def is_valid_dep_name(name):
     return name and ':' not in name
 
@@ -39,9 +57,7 @@ def parse_lockfile(root, log):
                 raise RuntimeError('expected "type" attribute for crate {}'.format(path))
             handler = self_handler
         else:
-            handler = _crate_types.get(type)
-            if handler is None:
-                raise RuntimeError('unknown dependency type: {}'.format(type))
+            handler = get_handler(type)
         remote, ver = handler.load_lock(spec)
 
         crate = Crate(root, name, handler, remote, ver, log)
@@ -57,8 +73,6 @@ def parse_lockfile(root, log):
         crate._deps = deps
         del crate._raw_deps
 
-        crate.reload_deps()
-
     return _LockFile(root, crates, log)
 
 class Crate:
@@ -71,26 +85,46 @@ class Crate:
         self._remote = remote
         self._version = ver
         self._root = root
-        self._gen = None
         self._deps = {}
-        self._dep_specs = {}
 
-    def fetch(self):
-        self._handler.fetch(self.path, self._log)
+        # Loaded from the DEPS file on first use.
+        self._gen = None
+        self._dep_specs = None
+
+        # The lockfile indexing this crate, kept informed by `set_dep`.
+        self._lock = None
+
+    def fetch(self, dep_spec):
+        with trace.span('fetch', crate=self.name):
+            self._handler.fetch(self._remote, self.path, dep_spec, self._log)
+
+    def prefetch(self, dep_spec, log=None):
+        with trace.span('prefetch', crate=self.name):
+            return self._handler.prefetch(self._remote, self.path, self._version, dep_spec, log or self._log)
 
     def versions(self, dep_spec):
+        # Versions are listed lazily; the git calls listing them
+        # show up in traces on their own.
         return self._handler.versions(self.path, dep_spec, self._log)
 
     def gen_stmts(self):
-        if self._gen is None:
-            self.reload_deps()
+        self._load_deps()
         return self._gen
 
     def reload_deps(self):
+        # The DEPS file will be read again when it's needed next time.
+        self._gen = None
+        self._dep_specs = None
+
+    def _load_deps(self):
+        if self._dep_specs is not None:
+            return
+
+        from .depsfile import load_deps
         try:
-            with open(os.path.join(self.path, 'DEPS'), 'r') as fin:
-                d = cson.load(fin)
-        except IOError as e:
+            with trace.span('load DEPS', crate=self.name):
+                d = load_deps(os.path.join(self.path, 'DEPS'))
+        except (IOError, OSError) as e:
             if e.errno != errno.ENOENT:
                 raise
             d = {}
@@ -102,21 +136,33 @@ class Crate:
             else:
                 self._gen = gen
 
-        self._dep_specs = {}
+        dep_specs = {}
         for dep_name, spec in six.iteritems(d.get('dependencies', {})):
-            handler = _crate_types[spec['type']]
-            self._dep_specs[dep_name] = handler.load_depspec(spec)
+            handler = get_handler(spec['type'])
+            dep_specs[dep_name] = handler.load_depspec(spec)
+        self._dep_specs = dep_specs
 
     def current_version(self):
         return self._version
 
     def get_dep_specs(self, ver):
-        d = self._handler.get_deps_file(self.path, ver, self._log)
-        d = cson.loads(d)
+        # The DEPS file of an immutable version never changes,
+        # so the parsed specs can be shared across runs and projects.
+        key = self._handler.cache_key(self._remote, ver)
+        cache = deps_cache() if key is not None else None
+
+        d = cache.get(key) if cache is not None else None
+        if d is None:
+            from .depsfile import parse_deps
+            with trace.span('read DEPS', crate=self.name):
+                d = self._handler.get_deps_file(self.path, ver, self._log)
+                d = parse_deps(d.encode('utf-8')).get('dependencies', {})
+            if cache is not None:
+                cache.put(key, d)
 
         r = {}
-        for dep_name, spec in six.iteritems(d.get('dependencies', {})):
-            handler = _crate_types[spec['type']]
+        for dep_name, spec in six.iteritems(d):
+            handler = get_handler(spec['type'])
             r[dep_name] = handler.load_depspec(spec)
 
         return r
@@ -125,14 +171,19 @@ class Crate:
         return self._handler == self_handler
 
     def is_compatible_ver(self, ver, ds):
-        return self._handler.is_compatible_ver(self.path, self._log, ver, ds)
+        with trace.span('is_compatible', crate=self.name):
+            return self._handler.is_compatible_ver(self.path, self._log, ver, ds)
 
-    def checkout(self, ver=None):
+    def checkout(self, ver=None, log=None):
         if ver is None:
             ver = self._version
-        self._handler.checkout(self._remote, ver, self.path, self._log)
+        with trace.span('checkout', crate=self.name):
+            self._handler.checkout(self._remote, ver, self.path, log or self._log)
         self._version = ver
 
+    def is_checked_out(self):
+        return self._handler.is_checked_out(self.path, self._version)
+
     def update(self):
         new_ver = self._handler.current_version(self.path, self._log)
         if new_ver is None:
@@ -146,6 +197,7 @@ class Crate:
         return self._deps.get(dep)
 
     def get_dep_spec(self, dep_name):
+        self._load_deps()
         return self._dep_specs.get(dep_name)
 
     def empty_dep_spec(self):
@@ -155,22 +207,29 @@ class Crate:
         return six.iteritems(self._deps)
 
     def dep_specs(self):
+        self._load_deps()
         return six.iteritems(self._dep_specs)
 
     def set_dep(self, name, target_crate):
         if not is_valid_dep_name(name):
             raise RuntimeError('invalid name for a dependency'.format(':'))
+        old = self._deps.get(name)
         self._deps[name] = target_crate
+        if self._lock is not None:
+            self._lock._dep_changed(self, name, old, target_crate)
 
-    def is_dirty(self):
-        return self._handler.is_dirty(self.path, self._log)
+    def is_dirty(self, log=None):
+        with trace.span('is_dirty', crate=self.name):
+            return self._handler.is_dirty(self.path, log or self._log)
 
-    def status(self):
+    def status(self, log=None):
         if not os.path.isdir(self.path):
             return 'D '
 
-        new_ver = self._handler.current_version(self.path, self._log)
-        dirty = self._handler.is_dirty(self.path, self._log)
+        log = log or self._log
+        with trace.span('status', crate=self.name):
+            new_ver = self._handler.current_version(self.path, log)
+            dirty = self._handler.is_dirty(self.path, log)
         if new_ver is None:
             return '! '
 
@@ -182,12 +241,100 @@ class Crate:
             d['dependencies'] = { name: crate.name for name, crate in six.iteritems(self._deps) }
         return d
 
+def _split_name(name):
+    return name.split('/') if name else []
+
+# Maps crate names to crates by their path components.
+class _PathTrie:
+    def __init__(self):
+        # Each node is a `[crate, children]` pair.
+        self._root = [None, {}]
+
+    def add(self, name, crate):
+        node = self._root
+        for part in _split_name(name):
+            node = node[1].setdefault(part, [None, {}])
+        node[0] = crate
+
+    def remove(self, name):
+        node = self._root
+        path = []
+        for part in _split_name(name):
+            path.append((node, part))
+            node = node[1].get(part)
+            if node is None:
+                return
+
+        node[0] = None
+        while path and node[0] is None and not node[1]:
+            node, part = path.pop()
+            del node[1][part]
+
+    def find(self, name):
+        # The crate with the longest name that is a prefix of `name`.
+        node = self._root
+        r = node[0]
+        for part in _split_name(name):
+            node = node[1].get(part)
+            if node is None:
+                break
+            if node[0] is not None:
+                r = node[0]
+        return r
+
+class _Transaction:
+    def __init__(self, lock):
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock._tx_depth += 1
+        return self
+
+    def __exit__(self, type, value, tb):
+        lock = self._lock
+        lock._tx_depth -= 1
+        if lock._tx_depth:
+            return False
+
+        force, lock._pending_save = lock._pending_save, None
+        journaled, lock._journaled = lock._journaled, False
+        # The journal is only obsolete once the lock lists its crates.
+        if type is None and force is not None:
+            lock._write(force)
+            if journaled:
+                lock._clear_journal()
+        return False
+
 class _LockFile:
     def __init__(self, root, crates, log):
         self._root = root
         self._crates = crates
         self.log = log
 
+        # See `transaction`.
+        self._tx_depth = 0
+        self._pending_save = None
+        self._journaled = False
+
+        self._paths = _PathTrie()
+        self._by_remote = {}
+        self._dependents = {}
+        for crate in six.itervalues(crates):
+            self._index(crate)
+        for crate in six.itervalues(crates):
+            for name, target in crate.deps():
+                self._dependents.setdefault(target, set()).add((crate, name))
+
+    def _index(self, crate):
+        crate._lock = self
+        self._paths.add(crate.name, crate)
+        self._by_remote.setdefault(crate.remote(), set()).add(crate)
+
+    def _dep_changed(self, crate, name, old, new):
+        if old is not None:
+            self._dependents[old].discard((crate, name))
+        self._dependents.setdefault(new, set()).add((crate, name))
+
     def root(self):
         return self._root
 
@@ -195,14 +342,15 @@ class _LockFile:
         return six.itervalues(self._crates)
 
     def locate_crate(self, path):
-        rpath = self.crate_name_from_path(path)
-
         # There is a crate with path '', so this will surely find one
-        for crate_rpath in sorted(self._crates):
-            if crate_rpath.startswith(rpath):
-                return self._crates[crate_rpath]
+        return self._paths.find(self.crate_name_from_path(path))
 
-        assert False
+    def crates_with_remote(self, remote):
+        return set(self._by_remote.get(remote, ()))
+
+    def dependents(self, crate):
+        # The `(crate, dep_name)` pairs depending on `crate`.
+        return set(self._dependents.get(crate, ()))
 
     def crate_name_from_path(self, path):
         path = path or '.'
@@ -218,14 +366,14 @@ class _LockFile:
     def new_unique_crate_name(self, remote, deps_dir=None):
         hint = remote.name_hint()
         deps_dir = self.guess_deps_dir(deps_dir)
-        target_dir = os.path.join(deps_dir, hint)
-        if os.path.exists(target_dir):
-            target_dir += '-'
-            target_dir += random.choice(string.ascii_lowercase)
-            while os.path.exists(target_dir):
-                target_dir += random.choice(string.ascii_lowercase)
+        name = self.crate_name_from_path(os.path.join(deps_dir, hint))
 
-        return self.crate_name_from_path(target_dir)
+        r = name
+        i = 1
+        while r in self._crates or os.path.lexists(os.path.join(self._root, r)):
+            i += 1
+            r = '{}-{}'.format(name, i)
+        return r
 
     def guess_deps_dir(self, deps_dir=None):
         if deps_dir is not None:
@@ -256,19 +404,31 @@ class _LockFile:
 
         crate = Crate(self._root, crate_name, handler, remote, ver, self.log)
         self.add(crate)
+        self._journal(crate)
         return crate
 
     def add(self, crate):
         if crate.name in self._crates:
             raise RuntimeError('there already is a dependency in {}'.format(crate.name))
         self._crates[crate.name] = crate
+        self._index(crate)
+        for name, target in crate.deps():
+            self._dependents.setdefault(target, set()).add((crate, name))
 
     def remove(self, crate):
-        for c in six.itervalues(self._crates):
-            old_keys = set(dep for dep, target in c.deps() if target == crate)
-            for key in old_keys:
-                del c._deps[key]
+        for c, name in self._dependents.pop(crate, ()):
+            del c._deps[name]
+        for name, target in crate.deps():
+            self._dependents[target].discard((crate, name))
+
+        crates = self._by_remote[crate.remote()]
+        crates.discard(crate)
+        if not crates:
+            del self._by_remote[crate.remote()]
+
+        self._paths.remove(crate.name)
         del self._crates[crate.name]
+        crate._lock = None
 
     def get_crate(self, path):
         return self._crates.get(path)
@@ -294,10 +454,120 @@ class _LockFile:
         for dep in self.deps.values():
             go(os.path.join(self.root, dep.dir), '{}:'.format(dep.dir))
 
+    def _state_path(self, name):
+        # Bookkeeping that helps to skip work, kept where git won't
+        # show it as untracked. Roots outside of git get none.
+        git_dir = os.path.join(self._root, '.git')
+        if not os.path.isdir(git_dir):
+            return None
+        return os.path.join(git_dir, 'crater', '{}.json'.format(name))
+
+    def load_state(self, name):
+        path = self._state_path(name)
+        if path is None:
+            return None
+
+        try:
+            with open(path, 'r') as fin:
+                return json.load(fin)
+        except (IOError, ValueError):
+            return None
+
+    def save_state(self, name, value):
+        path = self._state_path(name)
+        if path is None:
+            return
+
+        try:
+            dir = os.path.dirname(path)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+            with open(path, 'w') as fout:
+                json.dump(value, fout)
+        except (IOError, OSError):
+            pass
+
+    def close(self):
+        self_handler.close()
+        for handler in list(six.itervalues(_handlers)):
+            handler.close()
+
     def is_empty(self):
         return len(self._crates) == 1 and not self._crates['']._deps
 
+    def transaction(self):
+        # Saves are deferred to the end of the block and dropped if it raises;
+        # crates cloned meanwhile are journaled for `resume`.
+        return _Transaction(self)
+
+    def _journal(self, crate):
+        if not self._tx_depth:
+            return
+
+        path = self._state_path('journal')
+        if path is None:
+            return
+
+        # One line per crate, so that recording a crate doesn't mean
+        # rewriting everything recorded before.
+        try:
+            dir = os.path.dirname(path)
+            if not os.path.isdir(dir):
+                os.makedirs(dir)
+            with open(path, 'a') as fout:
+                fout.write(json.dumps({ 'name': crate.name, 'lock': crate.save() }, sort_keys=True))
+                fout.write('\n')
+            self._journaled = True
+        except (IOError, OSError):
+            pass
+
+    def _clear_journal(self):
+        try:
+            os.remove(self._state_path('journal'))
+        except OSError:
+            pass
+
+    def resume(self):
+        # Adds back the crates journaled by an interrupted transaction.
+        path = self._state_path('journal')
+        if path is None:
+            return []
+
+        try:
+            with open(path, 'r') as fin:
+                lines = fin.readlines()
+        except IOError:
+            return []
+
+        r = []
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # The last line may have been cut short.
+                continue
+
+            name = entry['name']
+            if name in self._crates or not os.path.isdir(os.path.join(self._root, name)):
+                continue
+
+            spec = entry['lock']
+            handler = get_handler(spec['type'])
+            remote, ver = handler.load_lock(spec)
+            crate = Crate(self._root, name, handler, remote, ver, self.log)
+            self.add(crate)
+            r.append(crate)
+
+        self._journaled = self._journaled or self._tx_depth > 0
+        return r
+
     def save(self, force=False):
+        if self._tx_depth:
+            self._pending_save = bool(self._pending_save) or force
+            return
+        self._write(force)
+
+    def _write(self, force):
         d = { crate.name: crate.save() for crate in six.itervalues(self._crates) }
 
         assert '' in d
@@ -306,6 +576,5 @@ class _LockFile:
         if not force and self.is_empty() and not os.path.isfile(path):
             return
 
-        with open(path, 'w') as fout:
-            json.dump(d, fout, indent=2, sort_keys=True)
+        write_if_changed(path, json.dumps(d, indent=2, sort_keys=True).encode('utf-8'))
 
@@ -1,24 +1,124 @@
-import subprocess, os, threading, colorama
+import subprocess, os, sys, re, threading, codecs
 
 from subprocess import CalledProcessError
+from . import trace
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
+
+_ansi_re = re.compile('\033\\[[0-9;]*[a-zA-Z]?|\033\\][^\a]*\a')
+
+# Pipes can't be waited on with select on Windows.
+_use_selectors = selectors is not None and sys.platform != 'win32'
+
+_chunk_size = 64 * 1024
 
 class _Dimmer:
-    def __init__(self, stream):
-        self._stream = colorama.AnsiToWin32(stream, convert=True, strip=True, autoreset=True)
+    def __init__(self, stream, convert=True):
+        self._decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        # Escape sequences in the child's output are always stripped;
+        # colorama is only needed to translate our own dimming
+        # into console calls on Windows.
+        if convert and sys.platform == 'win32':
+            import colorama
+            self._stream = colorama.AnsiToWin32(stream, convert=True, strip=True, autoreset=True)
+            self._prefix = colorama.Style.BRIGHT + colorama.Fore.BLACK
+        else:
+            self._stream = stream
+            self._prefix = ''
 
     def write(self, s):
-        self._stream.write(colorama.Style.BRIGHT + colorama.Fore.BLACK + s)
+        s = _ansi_re.sub('', s)
+        if s:
+            self._stream.write(self._prefix + s)
+
+    def write_bytes(self, s):
+        self.write(self._decoder.decode(s))
 
     def flush(self):
-        pass
+        self.write(self._decoder.decode(b'', True))
+
+def _pump(sinks):
+    # Passes the chunks read from each `(pipe, fn)` of `sinks` to its `fn`
+    # until all the pipes are closed.
+    if len(sinks) == 1 or not _use_selectors:
+        # Read all pipes but the last one on background threads.
+        threads = []
+        for pipe, fn in sinks[:-1]:
+            thr = threading.Thread(target=_drain, args=(pipe, fn))
+            thr.daemon = True
+            thr.start()
+            threads.append(thr)
+
+        _drain(*sinks[-1])
+        for thr in threads:
+            thr.join()
+        return
+
+    sel = selectors.DefaultSelector()
+    try:
+        for pipe, fn in sinks:
+            sel.register(pipe, selectors.EVENT_READ, fn)
+
+        while sel.get_map():
+            for key, _ in sel.select():
+                data = os.read(key.fd, _chunk_size)
+                if data:
+                    key.data(data)
+                else:
+                    sel.unregister(key.fileobj)
+                    key.fileobj.close()
+    finally:
+        sel.close()
+
+def _drain(pipe, fn):
+    fd = pipe.fileno()
+    while True:
+        data = os.read(fd, _chunk_size)
+        if not data:
+            break
+        fn(data)
+    pipe.close()
+
+def _command_name(argv):
+    # Spans are named after the command, so `git -c key=value checkout`
+    # becomes `git checkout`.
+    args = iter(argv[1:])
+    for arg in args:
+        if arg in ('-c', '-C'):
+            next(args, None)
+        elif not arg.startswith('-'):
+            return '{} {}'.format(argv[0], arg)
+    return argv[0]
+
+def _trace_span(args, kw):
+    cmd = args[0] if args else kw.get('args')
+    argv = [str(arg) for arg in cmd] if isinstance(cmd, (list, tuple)) else [str(cmd)]
+    return trace.span(_command_name(argv), 'subprocess', argv=argv, cwd=kw.get('cwd'))
 
 class Log:
     def __init__(self, stderr):
         self._stderr = stderr
-        self._dimmed = colorama.AnsiToWin32(_Dimmer(stderr), convert=False, strip=True, autoreset=False)
+        self._dimmed = _Dimmer(stderr)
         self._devnull = open(os.devnull, 'r+b')
+        self._lock = threading.Lock()
+
+    def block(self):
+        return _BlockLog(self)
+
+    def _write_dimmed(self, s):
+        self._dimmed.write_bytes(s)
 
     def call(self, *args, **kw):
+        with _trace_span(args, kw) as span:
+            r = self._call(*args, **kw)
+            span.set('returncode', r)
+            return r
+
+    def _call(self, *args, **kw):
         if 'stdout' not in kw and 'stderr' not in kw:
             kw['stdout'] = subprocess.PIPE
             kw['stderr'] = subprocess.STDOUT
@@ -38,17 +138,11 @@ class Log:
             kw['stderr'] = self._devnull
 
         p = subprocess.Popen(*args, **kw)
-
-        src = getattr(p, src)
-
-        while True:
-            line = src.readline()
-            if not line:
-                break
-
-            self._dimmed.write(line.decode())
-
-        p.wait()
+        try:
+            _pump([(getattr(p, src), self._write_dimmed)])
+        finally:
+            self._dimmed.flush()
+            p.wait()
         return p.returncode
 
     def check_call(self, *args, **kw):
@@ -57,6 +151,10 @@ class Log:
             raise subprocess.CalledProcessError(r, args[0])
 
     def check_output(self, *args, **kw):
+        with _trace_span(args, kw):
+            return self._check_output(*args, **kw)
+
+    def _check_output(self, *args, **kw):
         if 'stderr' not in kw:
             kw['stderr'] = subprocess.PIPE
         else:
@@ -65,33 +163,46 @@ class Log:
         p = subprocess.Popen(*args, stdout=subprocess.PIPE, **kw)
 
         stdout = []
-        def reader():
-            stdout.append(p.stdout.read())
-
-        thr = threading.Thread(target=reader)
-        thr.start()
-
-        line = []
-        while True:
-            line.append(p.stderr.read(1))
-            if not line[-1]:
-                self._dimmed.write(b''.join(line[:-1]).decode())
-                break
-
-            if line[-1] in b'\r\n':
-                self._dimmed.write(b''.join(line).decode())
-                line = []
-
-        thr.join()
+        try:
+            _pump([(p.stdout, stdout.append), (p.stderr, self._write_dimmed)])
+        finally:
+            self._dimmed.flush()
+            p.wait()
 
-        p.wait()
         if p.returncode != 0:
             raise subprocess.CalledProcessError(p.returncode, args[0])
 
-        return stdout[0]
+        return b''.join(stdout)
 
     def write(self, s):
         self._stderr.write(s)
 
     def error(self, s):
         self._stderr.write('error: {}\n'.format(s))
+
+class _BlockWriter:
+    def __init__(self, chunks, dimmed):
+        self._chunks = chunks
+        self._dimmed = dimmed
+
+    def write(self, s):
+        self._chunks.append((self._dimmed, s))
+
+# Collects the output of a parallel job; `flush` writes it in one piece.
+class _BlockLog(Log):
+    def __init__(self, parent):
+        self._parent = parent
+        self._chunks = []
+        self._stderr = _BlockWriter(self._chunks, False)
+        self._dimmed = _Dimmer(_BlockWriter(self._chunks, True), convert=False)
+        self._devnull = parent._devnull
+        self._lock = parent._lock
+
+    def flush(self):
+        chunks, self._chunks[:] = list(self._chunks), []
+        with self._lock:
+            for dimmed, s in chunks:
+                if dimmed:
+                    self._parent._dimmed.write(s)
+                else:
+                    self._parent.write(s)
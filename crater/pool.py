@@ -0,0 +1,66 @@
+import os, threading
+from six.moves import queue
+
+def default_jobs():
+    # Jobs spend most of their time waiting for git.
+    cpu_count = getattr(os, 'cpu_count', None)
+    if cpu_count is None:
+        # Python 2 only has it in multiprocessing, which is slow to import.
+        import multiprocessing
+        cpu_count = multiprocessing.cpu_count
+
+    try:
+        return min(8, 2 * (cpu_count() or 2))
+    except NotImplementedError:
+        return 4
+
+def run_jobs(fn, items, log, jobs=1):
+    # Runs at most `jobs` calls of `fn(item, log)` at a time. Returns
+    # `(item, result, error)` triples in the order of `items`.
+    items = list(items)
+    r = [None] * len(items)
+
+    def run_one(idx, job_log):
+        item = items[idx]
+        try:
+            r[idx] = item, fn(item, job_log), None
+        except Exception as e:
+            r[idx] = item, None, e
+
+    if jobs is None or jobs < 1:
+        jobs = 1
+    jobs = min(jobs, len(items))
+
+    if jobs <= 1:
+        for idx in range(len(items)):
+            run_one(idx, log)
+        return r
+
+    q = queue.Queue()
+    for idx in range(len(items)):
+        q.put(idx)
+
+    def worker():
+        while True:
+            try:
+                idx = q.get_nowait()
+            except queue.Empty:
+                return
+
+            job_log = log.block()
+            try:
+                run_one(idx, job_log)
+            finally:
+                job_log.flush()
+
+    threads = [threading.Thread(target=worker, name='job-{}'.format(i + 1)) for i in range(jobs)]
+    for thr in threads:
+        thr.daemon = True
+        thr.start()
+
+    for thr in threads:
+        # Join with a timeout so that KeyboardInterrupt gets through.
+        while thr.is_alive():
+            thr.join(0.1)
+
+    return r
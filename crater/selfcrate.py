@@ -21,15 +21,21 @@ class SelfVersion:
         return hash(None)
 
 class SelfHandler:
-    def fetch(self, path, log):
+    def fetch(self, remote, path, dep_spec, log):
         pass
 
+    def prefetch(self, remote, path, ver, dep_spec, log):
+        return []
+
     def versions(self, path, dep_spec, log):
         return [SelfVersion()]
 
     def checkout(self, remote, version, path, log):
         pass
 
+    def is_checked_out(self, path, ver):
+        return True
+
     def save_lock(self, remote, ver):
         return {}
 
@@ -43,6 +49,10 @@ class SelfHandler:
         except IOError:
             return '{}'
 
+    def cache_key(self, remote, ver):
+        # The DEPS file of the self crate lives in the working tree.
+        return None
+
     def current_version(self, path, log):
         return SelfVersion()
 
@@ -55,4 +65,7 @@ class SelfHandler:
     def empty_dep_spec(self):
         return SelfDepSpec()
 
+    def close(self):
+        pass
+
 self_handler = SelfHandler()
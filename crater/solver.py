@@ -0,0 +1,117 @@
+from collections import OrderedDict
+
+class _Level:
+    def __init__(self, crate, spec, reasons, candidates, pending):
+        self.crate = crate
+        self.spec = spec
+
+        # The crates whose versions put `crate` into the graph and
+        # constrained it to `spec`.
+        self.reasons = reasons
+
+        self.candidates = candidates
+
+        # Crates waiting to be locked, not counting `crate` itself.
+        self.pending = pending
+
+        # Crates whose versions caused some of the candidates to be rejected.
+        self.conflict = set()
+
+def solve(root, root_spec, versions, dependencies, is_compatible):
+    # Locks crates one at a time in the order they're discovered. When all
+    # the candidates of a crate fail, the earlier choices to blame are learned
+    # and the search jumps back to the latest of them. Returns None if there
+    # is no solution.
+    assignment = {}
+
+    # Learned incompatibilities, indexed by each of their (crate, version)
+    # terms. Each is a dict of versions that can't all be chosen together.
+    nogoods = {}
+
+    deps_memo = {}
+    def get_dependencies(crate, ver):
+        key = crate, ver
+        r = deps_memo.get(key)
+        if r is None:
+            r = list(dependencies(crate, ver))
+            deps_memo[key] = r
+        return r
+
+    def try_candidate(level, ver):
+        # Returns (conflict, None) if the candidate must be rejected and
+        # (None, pending) with the updated queue of crates otherwise.
+        crate = level.crate
+
+        for nogood in nogoods.get((crate, ver), ()):
+            if all(c is crate or assignment.get(c) == v for c, v in nogood.items()):
+                return set(c for c in nogood if c is not crate), None
+
+        pending = OrderedDict(level.pending)
+        for tgt, ds in get_dependencies(crate, ver):
+            if tgt in assignment:
+                if not is_compatible(tgt, assignment[tgt], ds):
+                    return set([tgt]), None
+            elif tgt in pending:
+                spec, reasons = pending[tgt]
+                spec = spec.join(ds)
+                if spec is None:
+                    return set(reasons), None
+                pending[tgt] = spec, reasons | frozenset([crate])
+            else:
+                pending[tgt] = ds, frozenset([crate])
+
+        return None, pending
+
+    def next_candidate(level):
+        for ver in level.candidates:
+            assignment[level.crate] = ver
+            conflict, pending = try_candidate(level, ver)
+            if conflict is None:
+                return pending
+
+            del assignment[level.crate]
+            level.conflict.update(conflict)
+
+        return None
+
+    def open_level(pending):
+        crate = next(iter(pending))
+        spec, reasons = pending[crate]
+
+        rest = OrderedDict(pending)
+        del rest[crate]
+        return _Level(crate, spec, reasons, iter(versions(crate, spec)), rest)
+
+    stack = []
+    pending = OrderedDict([(root, (root_spec, frozenset()))])
+    while pending:
+        stack.append(open_level(pending))
+
+        while True:
+            level = stack[-1]
+            pending = next_candidate(level)
+            if pending is not None:
+                break
+
+            # All candidates were rejected. The choices responsible are those
+            # that rejected the candidates and those that constrained the crate.
+            stack.pop()
+            conflict = level.conflict
+            conflict.update(level.reasons)
+            conflict.discard(level.crate)
+            if not conflict:
+                return None
+
+            nogood = dict((c, assignment[c]) for c in conflict)
+            for c, v in nogood.items():
+                nogoods.setdefault((c, v), []).append(nogood)
+
+            while stack[-1].crate not in conflict:
+                del assignment[stack.pop().crate]
+
+            target = stack[-1]
+            del assignment[target.crate]
+            conflict.discard(target.crate)
+            target.conflict.update(conflict)
+
+    return dict(assignment)
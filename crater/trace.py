@@ -0,0 +1,106 @@
+# Records spans in the Chrome trace event format. Tracing is off unless
+# `start` is called; `span` is then cheap enough for hot paths.
+
+import json, os, threading, time
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+class Tracer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self._threads = {}
+        self._pid = os.getpid()
+        self._epoch = _clock()
+
+    def _tid(self):
+        thr = threading.current_thread()
+        with self._lock:
+            r = self._threads.get(thr.ident)
+            if r is None:
+                r = len(self._threads) + 1
+                self._threads[thr.ident] = r
+                self._events.append({
+                    'name': 'thread_name',
+                    'ph': 'M',
+                    'pid': self._pid,
+                    'tid': r,
+                    'args': { 'name': thr.name },
+                    })
+            return r
+
+    def add(self, name, cat, start, end, args):
+        tid = self._tid()
+        ev = {
+            'name': name,
+            'cat': cat,
+            'ph': 'X',
+            'ts': (start - self._epoch) * 1e6,
+            'dur': (end - start) * 1e6,
+            'pid': self._pid,
+            'tid': tid,
+            }
+        if args:
+            ev['args'] = args
+
+        with self._lock:
+            self._events.append(ev)
+
+    def events(self):
+        with self._lock:
+            return list(self._events)
+
+    def save(self, path):
+        with open(path, 'w') as fout:
+            json.dump({ 'traceEvents': self.events(), 'displayTimeUnit': 'ms' }, fout)
+
+class _Span:
+    def __init__(self, tracer, name, cat, args):
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._args = args
+
+    def set(self, key, value):
+        self._args[key] = value
+
+    def __enter__(self):
+        self._start = _clock()
+        return self
+
+    def __exit__(self, type, value, tb):
+        end = _clock()
+        if type is not None:
+            self._args['error'] = '{}: {}'.format(type.__name__, value)
+        self._tracer.add(self._name, self._cat, self._start, end, self._args)
+        return False
+
+class _NullSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        return False
+
+_null_span = _NullSpan()
+_tracer = None
+
+def start():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def stop():
+    global _tracer
+    r, _tracer = _tracer, None
+    return r
+
+def span(name, cat='crater', **args):
+    # The keyword arguments are attached to the span.
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _Span(tracer, name, cat, args)
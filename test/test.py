@@ -1,6 +1,15 @@
-import shutil, tempfile, subprocess, os, sys, unittest, stat, json, re
+import shutil, tempfile, subprocess, os, sys, unittest, stat, json, re, random, time, threading, io, tarfile, zipfile, hashlib, zlib, traceback
+from six.moves import BaseHTTPServer
+from collections import OrderedDict
 from crater.log import Log
-from crater import crater
+from crater import crater, trace
+from crater.lockfile import parse_lockfile
+from crater.cache import DiskCache, deps_cache
+from crater.depsfile import load_deps
+from crater.solver import solve
+from crater.gitgraph import CommitGraph
+from crater.gitcrate import git_handler, GitDepSpec, GitRemote, _PythonBackend
+from crater.gitobjects import ObjectStore
 
 def _rmtree_ro(path):
     def del_rw(action, name, exc):
@@ -19,9 +28,18 @@ class Ctx:
         self._named_root = tempfile.mkdtemp()
         self._dirs = [self._named_root]
         os.chdir(self._root_dir)
+
+        self._prev_cache_dir = os.environ.get('CRATER_CACHE_DIR')
+        self.cache_dir = self.make_dir()
+        os.environ['CRATER_CACHE_DIR'] = self.cache_dir
         return self
 
     def tearDown(self):
+        if self._prev_cache_dir is None:
+            del os.environ['CRATER_CACHE_DIR']
+        else:
+            os.environ['CRATER_CACHE_DIR'] = self._prev_cache_dir
+
         for dir in reversed(self._dirs):
             _rmtree_ro(dir)
         os.chdir(self._prev_dir)
@@ -85,6 +103,9 @@ class TestLog:
     def close(self):
         self._devnull.close()
 
+    def block(self):
+        return _TestBlockLog(self)
+
     def call(self, *args, **kw):
         kw = dict(kw)
         if 'stdout' not in kw and 'stderr' not in kw:
@@ -132,6 +153,87 @@ class TestLog:
     def error(self, s):
         self.write('error: ' + s + '\n')
 
+class _RecordingLog(TestLog):
+    def __init__(self):
+        TestLog.__init__(self)
+        self.commands = []
+
+    def call(self, *args, **kw):
+        self.commands.append(args[0])
+        return TestLog.call(self, *args, **kw)
+
+class _TestBlockLog(TestLog):
+    def __init__(self, parent):
+        TestLog.__init__(self)
+        self._parent = parent
+
+    def flush(self):
+        self._parent._stdout.extend(self._stdout)
+        self._stdout = []
+        self.close()
+
+class _ArchiveServer:
+    """Serves archives from memory over HTTP, recording the requested paths."""
+
+    def __init__(self):
+        self.files = {}
+        self.requests = []
+        self.not_modified = 0
+
+        server = self
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                server.requests.append(self.path)
+                data = server.files.get(self.path)
+                if data is None:
+                    self.send_error(404)
+                    return
+                etag = '"{}"'.format(hashlib.sha1(data).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    server.not_modified += 1
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._httpd.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self._httpd.server_address[1], path)
+
+    def close(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+def _make_tar(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tf:
+        for name, content in sorted(files.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tf.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+def _make_zip(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for name, content in sorted(files.items()):
+            zf.writestr(name, content)
+    return buf.getvalue()
+
 class TestCrater(unittest.TestCase):
     def __init__(self, *args, **kw):
         super(TestCrater, self).__init__(*args, **kw)
@@ -203,6 +305,450 @@ class TestCrater(unittest.TestCase):
         self._crater_check_call(['checkout'])
         self.assertTrue(os.path.isfile('myrepo/content'))
 
+    def test_parallel_checkout(self):
+        repos = [self.ctx.make_repo(name='repo{}'.format(i)) for i in range(4)]
+        for i, repo in enumerate(repos):
+            self._crater_check_call(['add-git', repo.path, 'myrepo{}'.format(i)])
+            _rmtree_ro('myrepo{}'.format(i))
+
+        self._crater_check_call(['checkout', '-j', '3'])
+        for i in range(4):
+            self.assertTrue(os.path.isfile('myrepo{}/content'.format(i)))
+
+    def test_parallel_checkout_failure(self):
+        for name in ('good', 'bad'):
+            repo = self.ctx.make_repo(name=name)
+            self._crater_check_call(['add-git', repo.path, name])
+
+        j = _load_json('.deps.lock')
+        j['bad']['commit'] = '0' * 40
+        with open('.deps.lock', 'w') as fout:
+            json.dump(j, fout)
+
+        self.assertNotEqual(self._crater_call(['checkout', '-j', '2']), 0)
+        self.assertTrue(self._log.search_output('error: failed to check out bad'))
+
+    def test_mirror_dir(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        mirror_dir = self.ctx.make_dir()
+
+        self._crater_check_call(['--mirror-dir', mirror_dir, 'add-git', repo.path, 'myrepo'])
+        self.assertTrue(os.path.isfile('myrepo/content'))
+        self.assertTrue(os.path.isfile('myrepo/.git/objects/info/alternates'))
+
+        mirrors = os.listdir(mirror_dir)
+        self.assertEqual(len(mirrors), 1)
+        self.assertTrue(mirrors[0].startswith('test_repo-'))
+
+        repo.add('another_file')
+        c = repo.commit()
+        j = _load_json('.deps.lock')
+        j['myrepo']['commit'] = c
+        with open('.deps.lock', 'w') as fout:
+            json.dump(j, fout)
+
+        _rmtree_ro('myrepo')
+        self._crater_check_call(['--mirror-dir', mirror_dir, 'checkout'])
+        self.assertTrue(os.path.isfile('myrepo/another_file'))
+
+    def test_store_dir(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        store_dir = self.ctx.make_dir()
+
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        first = _load_json('.deps.lock')['myrepo']['commit']
+        _rmtree_ro('myrepo')
+
+        self._crater_check_call(['--store-dir', store_dir, 'checkout'])
+        self.assertFalse(os.path.islink('myrepo'))
+        entries = os.listdir(store_dir)
+        self.assertEqual(len(entries), 1)
+        entry = os.path.join(store_dir, entries[0], first)
+        self.assertTrue(os.path.samefile('myrepo/content', os.path.join(entry, 'content')))
+        self.assertFalse(os.stat('myrepo/content').st_mode & stat.S_IWUSR)
+
+        # Another project locking the same commit shares the entry.
+        other = self.ctx.make_dir()
+        shutil.copy('.deps.lock', os.path.join(other, '.deps.lock'))
+        self._crater_check_call(['--root', other, '--store-dir', store_dir, 'checkout'])
+        self.assertTrue(os.path.samefile(os.path.join(other, 'myrepo', 'content'), os.path.join(entry, 'content')))
+
+        self._crater_check_call(['commit'])
+        self.assertEqual(_load_json('.deps.lock')['myrepo']['commit'], first)
+        self.assertFalse(git_handler.is_dirty('myrepo', self._log))
+
+        # Newer commits are fetched into the crate, never into the entry.
+        repo.add('another_file')
+        second = repo.commit()
+        j = _load_json('.deps.lock')
+        j['myrepo']['commit'] = second
+        with open('.deps.lock', 'w') as fout:
+            json.dump(j, fout)
+
+        self._crater_check_call(['--store-dir', store_dir, 'checkout'])
+        self.assertTrue(os.path.isfile('myrepo/another_file'))
+        self.assertFalse(os.path.isfile(os.path.join(entry, 'another_file')))
+        self.assertEqual(git_handler.current_version(entry, self._log).hash, first)
+        self.assertNotEqual(subprocess.call(['git', 'cat-file', '-e', second], cwd=entry), 0)
+
+    def test_store_dir_keeps_generated_files_in_projects(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        repo.add('DEPS', json.dumps({ 'gen': { 'msbuild': {} } }))
+        repo.commit()
+        store_dir = self.ctx.make_dir()
+
+        self._crater_check_call(['add-git', repo.path, 'first'])
+        lock = _load_json('.deps.lock')
+        _rmtree_ro('first')
+
+        # The second project knows the same commit under another name.
+        other = self.ctx.make_dir()
+        lock['second'] = lock.pop('first')
+        with open(os.path.join(other, '.deps.lock'), 'w') as fout:
+            json.dump(lock, fout)
+
+        self._crater_check_call(['--store-dir', store_dir, 'checkout'])
+        self._crater_check_call(['--root', other, '--store-dir', store_dir, 'checkout'])
+
+        entry = os.path.join(store_dir, os.listdir(store_dir)[0], lock['second']['commit'])
+        self.assertEqual(sorted(os.listdir(entry)), ['.git', 'DEPS', 'content'])
+
+        for root, name in (('.', 'first'), (other, 'second')):
+            with open(os.path.join(root, name, 'deps.props')) as fin:
+                self.assertIn(os.path.abspath(os.path.join(root, name)), fin.read())
+
+    def test_shallow_checkout(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        for i in range(3):
+            repo.add('file{}'.format(i))
+            repo.commit()
+        subprocess.check_call(['git', 'branch', 'other'], cwd=repo.path)
+
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        _rmtree_ro('myrepo')
+
+        self._crater_check_call(['--clone', 'shallow', 'checkout'])
+        self.assertTrue(os.path.isfile('myrepo/file2'))
+        self.assertTrue(os.path.isfile('myrepo/.git/shallow'))
+
+        # History queries deepen the clone transparently.
+        versions = list(git_handler.versions('myrepo', GitDepSpec(['master']), self._log))
+        git_handler.close()
+        self.assertEqual(len(versions), 4)
+        self.assertFalse(os.path.isfile('myrepo/.git/shallow'))
+
+        # Only the branch asked for is fetched.
+        refs = subprocess.check_output(['git', 'for-each-ref', '--format=%(refname)'], cwd='myrepo').decode().split()
+        self.assertEqual(refs, ['refs/remotes/origin/master'])
+
+    def test_clone_mode_in_lock(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        _rmtree_ro('myrepo')
+
+        j = _load_json('.deps.lock')
+        j['myrepo']['clone'] = 'shallow'
+        with open('.deps.lock', 'w') as fout:
+            json.dump(j, fout)
+
+        self._crater_check_call(['checkout'])
+        self.assertTrue(os.path.isfile('myrepo/.git/shallow'))
+
+        self._crater_check_call(['commit'])
+        self.assertEqual(_load_json('.deps.lock')['myrepo']['clone'], 'shallow')
+
+    def test_dirty_check_fast_path(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+
+        # This file system has precise timestamps.
+        prev_slack = git_handler._timestamp_slack
+        git_handler._timestamp_slack = 0
+        try:
+            time.sleep(0.05)
+
+            log = _RecordingLog()
+            self.assertFalse(git_handler.is_dirty('myrepo', log))
+            self.assertTrue(log.commands)
+
+            log = _RecordingLog()
+            self.assertFalse(git_handler.is_dirty('myrepo', log))
+            self.assertEqual(log.commands, [])
+
+            # Untracked files can't make the crate dirty; git isn't asked.
+            os.makedirs('myrepo/build/obj')
+            with open('myrepo/build/obj/out.o', 'w') as fout:
+                fout.write('output')
+            log = _RecordingLog()
+            self.assertFalse(git_handler.is_dirty('myrepo', log))
+            self.assertEqual(log.commands, [])
+
+            with open('myrepo/content', 'a') as fout:
+                fout.write('dirtying content')
+
+            log = _RecordingLog()
+            self.assertTrue(git_handler.is_dirty('myrepo', log))
+            self.assertTrue(log.commands)
+
+            subprocess.check_call(['git', 'checkout', '-q', '--', 'content'], cwd='myrepo')
+            time.sleep(0.05)
+            self.assertFalse(git_handler.is_dirty('myrepo', log))
+            os.remove('myrepo/content')
+            log = _RecordingLog()
+            self.assertTrue(git_handler.is_dirty('myrepo', log))
+            self.assertTrue(log.commands)
+            log.close()
+        finally:
+            git_handler._timestamp_slack = prev_slack
+
+    def test_parallel_dirty_check(self):
+        for name in ('a', 'b', 'c'):
+            repo = self.ctx.make_repo(name=name)
+            self._crater_check_call(['add-git', repo.path, name])
+
+        self._crater_check_call(['commit', '-j', '3'])
+
+        with open('b/content', 'a') as fout:
+            fout.write('dirtying content')
+
+        self.assertNotEqual(self._crater_call(['commit', '-j', '3']), 0)
+        self.assertTrue(self._log.search_output('error: crate b has uncommitted changes'))
+
+    def test_checkout_skips_up_to_date_crates(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+
+        log = _RecordingLog()
+        self.assertEqual(crater._main(['checkout'], log), 0)
+        self.assertEqual(log.commands, [])
+
+        c = Git('myrepo')
+        c.add('another_file')
+        c.commit()
+
+        self.assertEqual(crater._main(['checkout'], log), 0)
+        self.assertTrue(log.commands)
+        self.assertFalse(os.path.isfile('myrepo/another_file'))
+        log.close()
+
+    def test_checkout_state(self):
+        Git(self.ctx._root_dir).init()
+
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        self._crater_check_call(['checkout'])
+        self.assertTrue(os.path.isfile('.git/crater/checkout.json'))
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'gen': { 'cmake': {} } }, fout)
+
+        # The root DEPS changed, so deps.cmake must be regenerated.
+        self._crater_check_call(['checkout'])
+        self.assertTrue(os.path.isfile('deps.cmake'))
+        with open('deps.cmake') as fin:
+            content = fin.read()
+
+        # So must generated files that were deleted or edited.
+        os.remove('deps.cmake')
+        self._crater_check_call(['checkout'])
+        with open('deps.cmake') as fin:
+            self.assertEqual(fin.read(), content)
+
+        with open('deps.cmake', 'w') as fout:
+            fout.write('edited')
+        self._crater_check_call(['checkout'])
+        with open('deps.cmake') as fin:
+            self.assertEqual(fin.read(), content)
+
+    def test_trace(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        self._crater_check_call(['--trace', 'trace.json', 'checkout'])
+
+        events = _load_json('trace.json')['traceEvents']
+        spans = [(ev['name'], ev.get('args', {}).get('crate')) for ev in events if ev['ph'] == 'X']
+        self.assertIn(('parse lockfile', None), spans)
+        self.assertIn(('checkout', 'myrepo'), spans)
+        self.assertIn(('gen', None), spans)
+
+        top = next(ev for ev in events if ev['name'] == 'checkout' and 'crate' not in ev.get('args', {}))
+        for ev in events:
+            if ev['ph'] == 'X' and ev.get('args', {}).get('crate') == 'myrepo':
+                self.assertGreaterEqual(ev['ts'], top['ts'])
+                self.assertLessEqual(ev['ts'] + ev['dur'], top['ts'] + top['dur'])
+
+    def test_trace_subprocesses(self):
+        tracer = trace.start()
+        try:
+            log = Log(sys.stderr)
+            log.check_output([sys.executable, '-c', 'print(1)'], cwd='.')
+            self.assertRaises(subprocess.CalledProcessError, log.check_call, [sys.executable, '-c', 'raise SystemExit(3)'])
+        finally:
+            trace.stop()
+
+        spans = [ev for ev in tracer.events() if ev['ph'] == 'X']
+        self.assertEqual(len(spans), 2)
+        self.assertEqual(spans[0]['cat'], 'subprocess')
+        self.assertEqual(spans[0]['args']['argv'], [sys.executable, '-c', 'print(1)'])
+        self.assertEqual(spans[1]['args']['returncode'], 3)
+
+    def test_archive_crate(self):
+        server = _ArchiveServer()
+        try:
+            tar = _make_tar({ 'bin/tool': b'binary', 'include/lib.h': b'header' })
+            server.files['/dist/tool-1.0.tar.gz'] = tar
+            url = server.url('/dist/tool-1.0.tar.gz')
+
+            Git(self.ctx._root_dir).init()
+            with open('DEPS', 'w') as fout:
+                json.dump({ 'dependencies': { 'tool': { 'type': 'archive', 'url': url } } }, fout)
+            self._crater_check_call(['upgrade'])
+
+            j = _load_json('.deps.lock')
+            self.assertEqual(j['']['dependencies'], { 'tool': '_deps/tool-1.0' })
+            self.assertEqual(j['_deps/tool-1.0'], { 'type': 'archive', 'url': url, 'sha256': hashlib.sha256(tar).hexdigest() })
+            with open('_deps/tool-1.0/include/lib.h', 'rb') as fin:
+                self.assertEqual(fin.read(), b'header')
+            self.assertEqual(len(server.requests), 1)
+
+            # Nothing is downloaded again while the extracted archive matches the lock.
+            self._crater_check_call(['checkout'])
+            shutil.rmtree('.git/crater')
+            self._crater_check_call(['checkout'])
+            self.assertEqual(len(server.requests), 1)
+
+            shutil.rmtree('_deps/tool-1.0')
+            self._crater_check_call(['checkout'])
+            self.assertEqual(len(server.requests), 2)
+            self.assertTrue(os.path.isfile('_deps/tool-1.0/bin/tool'))
+
+            self._crater_check_call(['status'])
+        finally:
+            server.close()
+
+    def test_archive_crate_upgrade(self):
+        server = _ArchiveServer()
+        try:
+            Git(self.ctx._root_dir).init()
+            url = server.url('/tool.tar.gz')
+
+            def serve(version, deps=None):
+                files = { 'version': version.encode() }
+                if deps is not None:
+                    files['DEPS'] = json.dumps({ 'dependencies': deps }).encode()
+                server.files['/tool.tar.gz'] = tar = _make_tar(files)
+                return hashlib.sha256(tar).hexdigest()
+
+            def upgrade(sha256):
+                spec = { 'type': 'archive', 'url': url }
+                if sha256 is not None:
+                    spec['sha256'] = sha256
+                with open('DEPS', 'w') as fout:
+                    json.dump({ 'dependencies': { 'tool': spec } }, fout)
+                self._crater_check_call(['upgrade'])
+                with open('_deps/tool/version') as fin:
+                    return _load_json('.deps.lock')['_deps/tool']['sha256'], fin.read()
+
+            first = serve('1')
+            self.assertEqual(upgrade(first), (first, '1'))
+
+            # An extracted archive matching the pinned hash isn't downloaded again.
+            requests = len(server.requests)
+            self.assertEqual(upgrade(first), (first, '1'))
+            self.assertEqual(len(server.requests), requests)
+
+            # A new pinned hash needs the new archive's DEPS.
+            repo = self.ctx.make_repo(name='B')
+            second = serve('2', { 'B': { 'type': 'git', 'url': repo.path } })
+            self.assertEqual(upgrade(second), (second, '2'))
+            self.assertTrue(os.path.isfile('_deps/B/content'))
+
+            # Unpinned archives are locked to whatever the url serves now.
+            third = serve('3')
+            self.assertEqual(upgrade(None), (third, '3'))
+            self.assertEqual(upgrade(None), (third, '3'))
+
+            # The url is asked whether the archive changed rather than downloaded.
+            self.assertEqual(server.not_modified, 1)
+            self.assertEqual(sorted(os.listdir('_deps')), ['B', 'tool'])
+        finally:
+            server.close()
+
+    def test_archive_crate_hash_mismatch(self):
+        server = _ArchiveServer()
+        try:
+            server.files['/tool.zip'] = _make_zip({ 'tool.txt': b'tool' })
+            with open('DEPS', 'w') as fout:
+                json.dump({ 'dependencies': { 'tool': { 'type': 'archive', 'url': server.url('/tool.zip'), 'sha256': '0' * 64 } } }, fout)
+
+            self.assertRaises(RuntimeError, self._crater_call, ['upgrade'])
+            self.assertFalse(os.path.exists('_deps/tool'))
+            self.assertEqual(os.listdir('_deps'), [])
+        finally:
+            server.close()
+
+    def test_lockfile_indexes(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        self._crater_check_call(['add-git', repo.path, 'nested/other'])
+        self._crater_check_call(['assign', '--force', 'a', 'myrepo'])
+        self._crater_check_call(['assign', '--force', 'myrepo:b', 'nested/other'])
+
+        lock = parse_lockfile(self.ctx._root_dir, self._log)
+        root, myrepo, other = lock.get_crate(''), lock.get_crate('myrepo'), lock.get_crate('nested/other')
+
+        self.assertIs(lock.locate_crate('myrepo'), myrepo)
+        self.assertIs(lock.locate_crate('myrepo/sub/dir'), myrepo)
+        self.assertIs(lock.locate_crate('nested'), root)
+        self.assertIs(lock.locate_crate('.'), root)
+        self.assertEqual(lock.crates_with_remote(myrepo.remote()), set([myrepo, other]))
+        self.assertEqual(lock.dependents(myrepo), set([(root, 'a')]))
+
+        root.set_dep('a', other)
+        self.assertEqual(lock.dependents(myrepo), set())
+        self.assertEqual(lock.dependents(other), set([(root, 'a'), (myrepo, 'b')]))
+
+        lock.remove(other)
+        self.assertIs(lock.locate_crate('nested/other'), root)
+        self.assertEqual(lock.crates_with_remote(myrepo.remote()), set([myrepo]))
+        self.assertIsNone(root.get_dep('a'))
+        self.assertIsNone(myrepo.get_dep('b'))
+
+        os.mkdir('_deps')
+        os.mkdir('_deps/test_repo')
+        self.assertEqual(lock.new_unique_crate_name(myrepo.remote(), '_deps'), '_deps/test_repo-2')
+
+    def test_gen_keeps_unchanged_files(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'gen': { 'cmake': {}, 'msbuild': {} } }, fout)
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+        self._crater_check_call(['assign', '--force', 'myrepo', 'myrepo'])
+
+        with open('deps.cmake', 'r') as fin:
+            self.assertIn('set(dep_myrepo myrepo)', fin.read())
+
+        past = os.stat('deps.cmake').st_mtime - 100
+        for name in ('deps.cmake', 'deps.props'):
+            os.utime(name, (past, past))
+
+        self._crater_check_call(['gen'])
+        for name in ('deps.cmake', 'deps.props'):
+            self.assertEqual(os.stat(name).st_mtime, past)
+
+        self._crater_check_call(['rm', 'myrepo'])
+        self.assertNotEqual(os.stat('deps.props').st_mtime, past)
+
+    def test_status_does_not_parse_deps(self):
+        repo = self.ctx.make_repo(name='test_repo')
+        self._crater_check_call(['add-git', repo.path, 'myrepo'])
+
+        with open('myrepo/DEPS', 'w') as fout:
+            fout.write('{ this is not valid')
+
+        self._crater_check_call(['status'])
+        self.assertRaises(Exception, self._crater_call, ['gen'])
+
     def test_simple_commit(self):
         repo = self.ctx.make_repo(name='test_repo')
         self._crater_check_call(['add-git', repo.path, 'myrepo'])
@@ -371,5 +917,586 @@ class TestCrater(unittest.TestCase):
         self.assertTrue(self._log.search_output(r'        :A'))
         self.assertTrue(self._log.search_output(r'        _deps/A:B'))
 
+    def test_recursive_upgrade_lock(self):
+        repo_b = self.ctx.make_repo(name='B')
+
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({
+            'dependencies': {
+                'B': {
+                    'type': 'git',
+                    'url': repo_b.path,
+                    }
+                }
+            }))
+        commit_a = repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({
+                'dependencies': {
+                        'A': {
+                            'type': 'git',
+                            'url': repo_a.path,
+                            },
+                    }
+                }, fout)
+
+        self._crater_check_call(['upgrade'])
+
+        j = _load_json('.deps.lock')
+        self.assertEqual(j['']['dependencies'], { 'A': '_deps/A' })
+        self.assertEqual(j['_deps/A']['commit'], commit_a)
+        self.assertEqual(j['_deps/A']['dependencies'], { 'B': '_deps/B' })
+        self.assertEqual(j['_deps/B']['commit'], repo_b.current_commit())
+
+    def test_upgrade_resumes_after_failure(self):
+        Git(self.ctx._root_dir).init()
+
+        # A's dependency doesn't exist yet, so the first upgrade fails
+        # after A has been cloned.
+        path_b = os.path.join(self.ctx._named_root, 'B')
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({ 'dependencies': { 'B': { 'type': 'git', 'url': path_b } } }))
+        commit_a = repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo_a.path } } }, fout)
+
+        self.assertRaises(subprocess.CalledProcessError, self._crater_call, ['upgrade'])
+        self.assertFalse(os.path.exists('.deps.lock'))
+        self.assertTrue(os.path.isdir('_deps/A'))
+        self.assertTrue(os.path.isfile('.git/crater/journal.json'))
+
+        repo_b = self.ctx.make_repo(name='B')
+        log = _RecordingLog()
+        self.assertEqual(crater._main(['upgrade'], log), 0)
+        self.assertFalse([cmd for cmd in log.commands if 'clone' in cmd and repo_a.path in cmd])
+        log.close()
+
+        j = _load_json('.deps.lock')
+        self.assertEqual(j['']['dependencies'], { 'A': '_deps/A' })
+        self.assertEqual(j['_deps/A']['commit'], commit_a)
+        self.assertEqual(j['_deps/A']['dependencies'], { 'B': '_deps/B' })
+        self.assertEqual(j['_deps/B']['commit'], repo_b.current_commit())
+        self.assertFalse(os.path.exists('.git/crater/journal.json'))
+
+        # Transactions that end without writing the lock keep the journal.
+        lock = parse_lockfile(self.ctx._root_dir, self._log)
+        try:
+            with lock.transaction():
+                lock.init_crate(GitRemote(repo_b.path), GitDepSpec(['master']), '_deps/C')
+        finally:
+            lock.close()
+        self.assertTrue(os.path.isfile('.git/crater/journal.json'))
+
+    def test_upgrade_caches_dep_specs(self):
+        repo_b = self.ctx.make_repo(name='B')
+
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({
+            'dependencies': {
+                'B': {
+                    'type': 'git',
+                    'url': repo_b.path,
+                    }
+                }
+            }))
+        commit_a = repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo_a.path } } }, fout)
+
+        self._crater_check_call(['upgrade'])
+
+        d = deps_cache().get('git\0{}\0{}'.format(repo_a.path, commit_a))
+        self.assertEqual(d, { 'B': { 'type': 'git', 'url': repo_b.path } })
+
+    def test_fetch_window(self):
+        repo_b = self.ctx.make_repo(name='B')
+
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({ 'dependencies': { 'B': { 'type': 'git', 'url': repo_b.path } } }))
+        repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo_a.path } } }, fout)
+
+        def fetches(argv):
+            log = _RecordingLog()
+            try:
+                self.assertEqual(crater._main(argv, log), 0)
+            finally:
+                log.close()
+            return [cmd for cmd in log.commands if 'fetch' in cmd]
+
+        # Every crate is fetched once per command...
+        self._crater_check_call(['upgrade'])
+        self.assertEqual(len(fetches(['upgrade'])), 2)
+
+        # ...unless it was fetched recently enough.
+        self.assertEqual(len(fetches(['--fetch-window', '3600', 'upgrade'])), 2)
+        self.assertEqual(fetches(['--fetch-window', '3600', 'upgrade']), [])
+
+    def test_fetches_tracked_branches_only(self):
+        repo = self.ctx.make_repo(name='A')
+        subprocess.check_call(['git', 'tag', 'v1'], cwd=repo.path)
+        subprocess.check_call(['git', 'checkout', '-q', '-b', 'other'], cwd=repo.path)
+        repo.add('other')
+        commit_other = repo.commit()
+        subprocess.check_call(['git', 'checkout', '-q', 'master'], cwd=repo.path)
+
+        def refs():
+            return subprocess.check_output(['git', 'for-each-ref', '--format=%(refname)'], cwd='_deps/A').decode().split()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo.path } } }, fout)
+        self._crater_check_call(['upgrade'])
+        self.assertIn('refs/remotes/origin/master', refs())
+        self.assertNotIn('refs/remotes/origin/other', refs())
+        self.assertNotIn('refs/tags/v1', refs())
+
+        # Branches of new specs are fetched when needed.
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo.path, 'branch': ['master', 'other'] } } }, fout)
+        self._crater_check_call(['upgrade'])
+        self.assertIn('refs/remotes/origin/other', refs())
+
+        # Branches that don't exist leave the clones usable.
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': {
+                'A': { 'type': 'git', 'url': repo.path, 'branch': ['master', 'missing'] },
+                'B': { 'type': 'git', 'url': repo.path, 'branch': ['master', 'missing'] },
+                } }, fout)
+        self.assertRaises(subprocess.CalledProcessError, self._crater_call, ['upgrade'])
+        self.assertFalse(os.path.exists('_deps/B'))
+        subprocess.check_call(['git', 'fetch', '-q', 'origin'], cwd='_deps/A')
+
+        # Locked commits off the default branch are fetched by hash.
+        j = _load_json('.deps.lock')
+        j['_deps/A']['commit'] = commit_other
+        with open('.deps.lock', 'w') as fout:
+            json.dump(j, fout)
+        _rmtree_ro('_deps/A')
+
+        self._crater_check_call(['checkout'])
+        self.assertTrue(os.path.isfile('_deps/A/other'))
+        self.assertNotIn('refs/remotes/origin/other', refs())
+
+    def test_python_git_backend(self):
+        repo_b = self.ctx.make_repo(name='B')
+
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({ 'dependencies': { 'B': { 'type': 'git', 'url': repo_b.path } } }))
+        repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo_a.path } } }, fout)
+        self._crater_check_call(['upgrade'])
+        expected = _load_json('.deps.lock')
+        os.remove('.deps.lock')
+        _rmtree_ro('_deps')
+        deps_cache().close()
+        shutil.rmtree(self.ctx.cache_dir)
+
+        log = _RecordingLog()
+        try:
+            self.assertEqual(crater._main(['--git-backend', 'python', 'upgrade'], log), 0)
+        finally:
+            log.close()
+        self.assertEqual(_load_json('.deps.lock'), expected)
+
+        reads = ('cat-file', 'log', 'rev-list', 'for-each-ref', 'rev-parse')
+        self.assertFalse([cmd for cmd in log.commands if cmd[1] in reads])
+
+    def test_prefetch(self):
+        mirror_dir = self.ctx.make_dir()
+        repo_b = self.ctx.make_repo(name='B')
+
+        repo_a = self.ctx.make_repo(name='A')
+        repo_a.add('DEPS', json.dumps({ 'dependencies': { 'B': { 'type': 'git', 'url': repo_b.path } } }))
+        repo_a.commit()
+
+        with open('DEPS', 'w') as fout:
+            json.dump({ 'dependencies': { 'A': { 'type': 'git', 'url': repo_a.path } } }, fout)
+        self._crater_check_call(['--mirror-dir', mirror_dir, 'upgrade'])
+        with open('.deps.lock', 'r') as fin:
+            lock = fin.read()
+
+        # A new commit of A depends on a remote no crate uses yet.
+        repo_c = self.ctx.make_repo(name='C')
+        repo_a.add('DEPS', json.dumps({ 'dependencies': {
+            'B': { 'type': 'git', 'url': repo_b.path },
+            'C': { 'type': 'git', 'url': repo_c.path },
+            } }))
+        commit_a = repo_a.commit()
+        _rmtree_ro('_deps/B')
+
+        self._crater_check_call(['--mirror-dir', mirror_dir, 'prefetch'])
+        with open('.deps.lock', 'r') as fin:
+            self.assertEqual(fin.read(), lock)
+        self.assertEqual(len(os.listdir(mirror_dir)), 3)
+        self.assertTrue(os.path.isdir('_deps/B/.git'))
+        self.assertFalse(os.path.exists('_deps/B/content'))
+        self.assertFalse(os.path.exists('_deps/C'))
+
+        out = subprocess.check_output(['git', 'rev-parse', 'origin/master'], cwd='_deps/A')
+        self.assertEqual(out.decode().strip(), commit_a)
+
+        log = _RecordingLog()
+        self.assertEqual(crater._main(['checkout'], log), 0)
+        self.assertFalse([cmd for cmd in log.commands if 'clone' in cmd or 'fetch' in cmd])
+        log.close()
+        self.assertTrue(os.path.isfile('_deps/B/content'))
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_modules_are_deferred(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(crater.__file__)))
+        out = subprocess.check_output([sys.executable, '-c', 'import sys, crater.crater; print(" ".join(sys.modules))'], cwd=root)
+        loaded = set(out.decode().split())
+        self.assertIn('crater.crater', loaded)
+        for name in ('cson', 'toposort', 'colorama', 'sqlite3', 'multiprocessing', 'requests', 'crater.solver', 'crater.gitgraph', 'crater.depsfile', 'crater.archivecrate', 'crater.gitobjects'):
+            self.assertNotIn(name, loaded)
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        _rmtree_ro(self._dir)
+
+    def test_roundtrip(self):
+        cache = DiskCache(os.path.join(self._dir, 'cache.sqlite'), 'test', 1024)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', { 'x': [1, 2] })
+        self.assertEqual(cache.get('a'), { 'x': [1, 2] })
+        cache.close()
+
+        cache = DiskCache(os.path.join(self._dir, 'cache.sqlite'), 'test', 1024)
+        self.assertEqual(cache.get('a'), { 'x': [1, 2] })
+        cache.close()
+
+    def test_lru_eviction(self):
+        cache = DiskCache(os.path.join(self._dir, 'cache.sqlite'), 'test', 1000)
+        for i in range(20):
+            cache.put('key{:02}'.format(i), 'x' * 90)
+
+        self.assertIsNone(cache.get('key00'))
+        self.assertIsNotNone(cache.get('key19'))
+        cache.close()
+
+class TestDepsFile(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._prev_cache_dir = os.environ.get('CRATER_CACHE_DIR')
+        os.environ['CRATER_CACHE_DIR'] = os.path.join(self._dir, 'cache')
+        os.mkdir(os.environ['CRATER_CACHE_DIR'])
+
+    def tearDown(self):
+        if self._prev_cache_dir is None:
+            del os.environ['CRATER_CACHE_DIR']
+        else:
+            os.environ['CRATER_CACHE_DIR'] = self._prev_cache_dir
+        _rmtree_ro(self._dir)
+
+    def test_load_deps_reparses_changed_files(self):
+        path = os.path.join(self._dir, 'DEPS')
+        with open(path, 'w') as fout:
+            fout.write("dependencies:\n  a:\n    type: 'git'\n")
+
+        past = time.time() - 100
+        os.utime(path, (past, past))
+        self.assertEqual(load_deps(path), { 'dependencies': { 'a': { 'type': 'git' } } })
+        self.assertEqual(load_deps(path), { 'dependencies': { 'a': { 'type': 'git' } } })
+
+        with open(path, 'w') as fout:
+            fout.write("dependencies:\n  b:\n    type: 'git'\n")
+        os.utime(path, (past + 1, past + 1))
+        self.assertEqual(load_deps(path), { 'dependencies': { 'b': { 'type': 'git' } } })
+
+        os.remove(path)
+        self.assertRaises((IOError, OSError), load_deps, path)
+
+class _FakeSpec:
+    def __init__(self, allowed):
+        self.allowed = frozenset(allowed)
+
+    def join(self, o):
+        return _FakeSpec(self.allowed & o.allowed)
+
+class _FakeGraph:
+    def __init__(self, versions, deps):
+        # versions: crate -> list of versions, most preferred first
+        # deps: (crate, ver) -> list of (target, allowed versions)
+        self._versions = versions
+        self._deps = deps
+        self.calls = 0
+
+    def versions(self, crate, spec):
+        self.calls += 1
+        return [ver for ver in self._versions[crate] if ver in spec.allowed]
+
+    def dependencies(self, crate, ver):
+        return [(tgt, _FakeSpec(allowed)) for tgt, allowed in self._deps.get((crate, ver), ())]
+
+    def is_compatible(self, crate, ver, spec):
+        return ver in spec.allowed
+
+    def solve(self, solver):
+        return solver('root', _FakeSpec([0]), self.versions, self.dependencies, self.is_compatible)
+
+def _reference_solve(root, root_spec, versions, dependencies, is_compatible):
+    # Plain chronological backtracking.
+    def lock_one(unlocked, locked):
+        if not unlocked:
+            return locked
+
+        unlocked = OrderedDict(unlocked)
+        c, spec = unlocked.popitem(last=False)
+        for ver in versions(c, spec):
+            l = dict(locked)
+            l[c] = ver
+            u = OrderedDict(unlocked)
+            for tgt, ds in dependencies(c, ver):
+                if tgt in l:
+                    if not is_compatible(tgt, l[tgt], ds):
+                        break
+                elif tgt in u:
+                    u[tgt] = u[tgt].join(ds)
+                else:
+                    u[tgt] = ds
+            else:
+                r = lock_one(u, l)
+                if r is not None:
+                    return r
+
+    return lock_one(OrderedDict([(root, root_spec)]), {})
+
+class TestSolver(unittest.TestCase):
+    def test_matches_backtracking(self):
+        rng = random.Random(1234)
+        for _ in range(500):
+            crates = ['c{}'.format(i) for i in range(rng.randint(1, 6))]
+            versions = { 'root': [0] }
+            for c in crates:
+                versions[c] = list(range(rng.randint(1, 4)))
+
+            deps = {}
+            for c in ['root'] + crates:
+                for ver in versions[c]:
+                    targets = rng.sample(crates, rng.randint(0, len(crates)))
+                    deps[c, ver] = [(tgt, rng.sample(versions[tgt], rng.randint(1, len(versions[tgt])))) for tgt in targets]
+
+            g = _FakeGraph(versions, deps)
+            self.assertEqual(g.solve(solve), g.solve(_reference_solve))
+
+    def test_backjumps_over_unrelated_crates(self):
+        # root depends on A, then on 15 unrelated crates with 3 versions each,
+        # then on C. Only the last version of A agrees with C.
+        # Plain backtracking would try 3**15 combinations for each version of A.
+        n = 15
+        versions = { 'root': [0], 'A': [0, 1, 2, 3], 'C': [3] }
+        deps = { ('root', 0): [('A', [0, 1, 2, 3])] }
+        deps['root', 0].extend(('x{}'.format(i), [0, 1, 2]) for i in range(n))
+        deps['root', 0].append(('C', [0, 1, 2, 3]))
+        for i in range(n):
+            versions['x{}'.format(i)] = [0, 1, 2]
+        for ver in versions['A']:
+            deps['A', ver] = [('C', [ver])]
+
+        g = _FakeGraph(versions, deps)
+        r = g.solve(solve)
+        self.assertEqual(r['A'], 3)
+        self.assertEqual(r['C'], 3)
+        self.assertLess(g.calls, 100)
+
+    def test_no_solution(self):
+        versions = { 'root': [0], 'A': [0, 1], 'B': [0] }
+        deps = {
+            ('root', 0): [('A', [0, 1]), ('B', [0])],
+            ('B', 0): [('A', [2])],
+            }
+
+        g = _FakeGraph(versions, deps)
+        self.assertIsNone(g.solve(solve))
+
+class TestCommitGraph(unittest.TestCase):
+    def setUp(self):
+        self.ctx = Ctx()
+        self.ctx.setUp()
+        self._log = TestLog()
+
+    def tearDown(self):
+        self.ctx.tearDown()
+        self._log.close()
+
+    def _git(self, repo, *args):
+        return subprocess.check_output(('git',) + args, cwd=repo.path).decode().strip()
+
+    def test_queries_match_git(self):
+        repo = self.ctx.make_repo(name='graph')
+        commits = [repo.current_commit()]
+
+        rng = random.Random(42)
+        branches = ['master']
+        for i in range(30):
+            op = rng.randint(0, 3)
+            if op == 0:
+                name = 'b{}'.format(i)
+                self._git(repo, 'checkout', '-q', '-b', name, rng.choice(commits))
+                branches.append(name)
+            elif op == 1 and len(branches) > 1:
+                self._git(repo, 'checkout', '-q', rng.choice(branches))
+                self._git(repo, '-c', 'user.name=Tester', '-c', 'user.email=test@example.com',
+                    'merge', '-q', '--no-edit', '-s', 'ours', rng.choice(branches))
+                commits.append(repo.current_commit())
+            else:
+                repo.add('file{}'.format(i))
+                commits.append(repo.commit())
+
+        g = CommitGraph.load(repo.path, self._log)
+        for b in branches:
+            self.assertEqual(g.resolve(b), self._git(repo, 'rev-parse', b))
+
+        for a in commits:
+            for b in commits:
+                r = subprocess.call(['git', 'merge-base', '--is-ancestor', a, b], cwd=repo.path)
+                self.assertEqual(g.is_ancestor(a, b), r == 0)
+
+        for _ in range(50):
+            sample = rng.sample(commits, rng.randint(1, 3))
+            expected = subprocess.Popen(['git', 'merge-base', '--all', '--octopus'] + sample, cwd=repo.path, stdout=subprocess.PIPE).communicate()[0]
+            self.assertEqual(sorted(g.merge_bases(sample)), sorted(expected.decode().split()))
+
+        self.assertIsNone(g.is_ancestor('0' * 40, commits[0]))
+
+    def test_paged_versions(self):
+        repo = self.ctx.make_repo(name='history')
+        for i in range(10):
+            repo.add('file{}'.format(i))
+            repo.commit()
+
+        clone = os.path.join(self.ctx.make_dir(), 'clone')
+        subprocess.check_call(['git', 'clone', '-q', '--no-checkout', repo.path, clone])
+
+        expected = self._git(repo, 'log', '--pretty=format:%H').split()
+
+        prev_page_size = git_handler.versions_page_size
+        git_handler.versions_page_size = 2
+        log = _RecordingLog()
+        try:
+            versions = git_handler.versions(clone, GitDepSpec(['master']), log)
+            self.assertEqual(next(versions).hash, expected[0])
+            self.assertEqual([expected[0]] + [ver.hash for ver in versions], expected)
+        finally:
+            git_handler.versions_page_size = prev_page_size
+            git_handler.close()
+            log.close()
+
+        # A single branch needs no commit graph.
+        self.assertFalse([cmd for cmd in log.commands if cmd[1] in ('rev-list', 'for-each-ref')])
+
+class TestObjectStore(unittest.TestCase):
+    def setUp(self):
+        self.ctx = Ctx()
+        self.ctx.setUp()
+        self._log = TestLog()
+
+    def tearDown(self):
+        self.ctx.tearDown()
+        self._log.close()
+
+    def _git(self, repo, *args):
+        return subprocess.check_output(('git',) + args, cwd=repo.path)
+
+    def _check_matches_git(self, repo, revs):
+        store = ObjectStore.open(repo.path)
+        try:
+            for rev in revs:
+                type = self._git(repo, 'cat-file', '-t', rev).decode().strip()
+                self.assertEqual(store.read_rev(rev), (type, self._git(repo, 'cat-file', type, rev)))
+            self.assertIsNone(store.read_rev('HEAD:missing'))
+            self.assertIsNone(store.read_rev('0' * 40))
+
+            refs, commits = store.commit_graph_input()
+            expected = CommitGraph.load(repo.path, self._log)
+            self.assertEqual(refs, expected._refs)
+            self.assertEqual(sorted(commits), sorted(line.split() for line in self._git(repo, 'rev-list', '--parents', '--all').splitlines()))
+
+            head = self._git(repo, 'rev-parse', 'HEAD').decode().strip()
+            refs, commits = store.commit_graph_input([head])
+            self.assertEqual(refs, {})
+            self.assertEqual(sorted(commits), sorted(line.split() for line in self._git(repo, 'rev-list', '--parents', head).splitlines()))
+
+            self.assertEqual(list(store.history(head)), self._git(repo, 'log', '--pretty=format:%H').decode().split())
+        finally:
+            store.close()
+
+    def test_reads_match_git(self):
+        repo = self.ctx.make_repo(name='objects')
+        os.mkdir(os.path.join(repo.path, 'dir'))
+        for i in range(20):
+            # Similar contents, so that the pack has deltas.
+            repo.add('dir/file', ''.join('line {}\n'.format(j) for j in range(i * 50)))
+            repo.add('DEPS', json.dumps({ 'version': i }))
+            repo.commit()
+        self._git(repo, 'tag', '-a', '-m', 'tag', 'v1', 'HEAD~3')
+        self._git(repo, 'branch', 'other', 'HEAD~5')
+
+        revs = ['HEAD', 'HEAD:DEPS', 'HEAD:dir/file', 'v1', 'v1^{commit}', 'v1:DEPS', 'other:dir']
+        self._check_matches_git(repo, revs)
+
+        self._git(repo, 'repack', '-a', '-d', '-f', '-q', '--depth=10', '--window=20')
+        self._git(repo, 'pack-refs', '--all')
+        self._check_matches_git(repo, revs)
+
+    def test_deep_delta_chain(self):
+        repo = self.ctx.make_repo(name='objects')
+        for i in range(200):
+            # A sliding window of lines is only close to its neighbours.
+            repo.add('file', ''.join('line {} of the file\n'.format(j) for j in range(i * 5, i * 5 + 400)))
+            repo.commit()
+        self._git(repo, 'repack', '-a', '-d', '-f', '-q', '--depth=250', '--window=250')
+        pack_dir = os.path.join(repo.path, '.git', 'objects', 'pack')
+        idx = [os.path.join(pack_dir, f) for f in os.listdir(pack_dir) if f.endswith('.idx')]
+        stats = self._git(repo, 'verify-pack', '-s', *idx).decode()
+        self.assertTrue(any(int(n) > 40 for n in re.findall(r'chain length = (\d+)', stats)))
+
+        blobs = self._git(repo, 'rev-parse', *['HEAD~{}:file'.format(i) for i in range(0, 200, 7)]).decode().split()
+
+        # Chains are resolved without recursing once per delta.
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(len(traceback.extract_stack()) + 30)
+        try:
+            store = ObjectStore.open(repo.path)
+            try:
+                objects = [store.read(blob) for blob in blobs]
+            finally:
+                store.close()
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(objects, [('blob', self._git(repo, 'cat-file', 'blob', blob)) for blob in blobs])
+
+    def test_history_falls_back_to_git(self):
+        repo = self.ctx.make_repo(name='objects')
+        for i in range(5):
+            repo.add('file', str(i))
+            repo.commit()
+        expected = self._git(repo, 'log', '--pretty=format:%H').decode().split()
+
+        backend = _PythonBackend(repo.path)
+        try:
+            # The reader gives up halfway through a corrupt history.
+            history = backend._store.history
+            def corrupt_history(hash):
+                it = history(hash)
+                yield next(it)
+                yield next(it)
+                raise zlib.error('corrupt')
+            backend._store.history = corrupt_history
+
+            self.assertEqual(list(backend.history('HEAD', self._log, 2, skip=1)), expected[1:])
+        finally:
+            backend.close()
+
 if __name__ == '__main__':
     unittest.main()